@@ -0,0 +1,327 @@
+"""
+Benchmarks of the hot paths of the SUEP analysis on synthetic events:
+sphericity, FastJetReclustering, getTopTwoJets, track_killing, convert_coords
+and run_inference_GNN, for a few chunk sizes.
+The time and the peak memory of each stage are written to a json file, with the
+commit they were measured on, so that two commits can be compared.
+Run from the top of the repository, no input files are needed:
+    python additional_tools/benchmarks/benchmark_suite.py --output bench_new.json
+    python additional_tools/benchmarks/benchmark_suite.py --output bench_old.json --compare bench_new.json
+The GNN stage uses the model of data/GNN/, and is skipped if torch
+or torch_geometric are not installed.
+"""
+import argparse
+import importlib.metadata
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import awkward as ak
+import numpy as np
+import vector
+
+vector.register_awkward()
+
+repo_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "../..")
+sys.path.append(repo_dir)
+import workflows.SUEP_utils as SUEP_utils
+from workflows.CMS_corrections.track_killing_utils import track_killing
+
+try:
+    import workflows.ML_utils as ML_utils
+except ImportError:
+    ML_utils = None
+
+stages = [
+    "track_killing",
+    "sphericity",
+    "fastjet",
+    "top_two_jets",
+    "convert_coords",
+    "gnn",
+]
+
+parser = argparse.ArgumentParser(description="SUEP benchmark suite")
+parser.add_argument(
+    "--chunksizes",
+    type=int,
+    nargs="+",
+    default=[1000, 5000, 20000],
+    help="events per chunk",
+)
+parser.add_argument(
+    "--stages", nargs="+", default=stages, choices=stages, help="stages to run"
+)
+parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage")
+parser.add_argument("--ue", type=float, default=80, help="mean soft tracks/event")
+parser.add_argument("--suep", type=float, default=70, help="mean SUEP tracks/event")
+parser.add_argument("--isr", type=float, default=25, help="mean ISR tracks/event")
+parser.add_argument("--nobj", type=int, default=1000, help="tracks/event in convert")
+parser.add_argument("--model", type=str, default="single_l5_bPfcand_S1_SUEPtracks")
+parser.add_argument("--config", type=str, default="config.yml", help="GNN config")
+parser.add_argument("--era", type=int, default=2018, help="era")
+parser.add_argument("--seed", type=int, default=42, help="random seed")
+parser.add_argument("--output", type=str, default="benchmark.json", help="json")
+parser.add_argument("--compare", type=str, default=None, help="json to compare to")
+options = parser.parse_args()
+
+
+def make_tracks(nevents, rng):
+    """
+    Synthetic PF candidates: a soft underlying event with a negative binomial
+    multiplicity (long tail of busy events), a collimated ISR jet and, opposite
+    to it in phi, a wide SUEP-like spray of soft tracks.
+    """
+
+    def component(mean, axis_eta, axis_phi, spread, mean_pt, min_pt=0.75):
+        if spread is None:
+            # uniform, negative binomial with shape 2 (variance mean + mean^2 / 2)
+            counts = rng.negative_binomial(2, 2 / (2 + mean), nevents)
+        else:
+            counts = rng.poisson(mean, nevents)
+        n = counts.sum()
+        if spread is None:
+            eta = rng.uniform(-2.5, 2.5, n)
+            phi = rng.uniform(-np.pi, np.pi, n)
+        else:
+            eta = np.repeat(axis_eta, counts) + rng.normal(0, spread, n)
+            phi = np.repeat(axis_phi, counts) + rng.normal(0, spread, n)
+        phi = (phi + np.pi) % (2 * np.pi) - np.pi
+        pt = min_pt + rng.exponential(mean_pt, n)
+        return {
+            "pt": ak.unflatten(pt, counts),
+            "eta": ak.unflatten(np.clip(eta, -2.5, 2.5), counts),
+            "phi": ak.unflatten(phi, counts),
+        }
+
+    isr_eta = np.clip(rng.normal(0, 1, nevents), -2, 2)
+    isr_phi = rng.uniform(-np.pi, np.pi, nevents)
+    suep_eta = np.clip(rng.normal(0, 1, nevents), -2, 2)
+    suep_phi = isr_phi + np.pi
+    components = [
+        component(options.ue, None, None, None, 1.5),
+        component(options.isr, isr_eta, isr_phi, 0.2, 8.0, min_pt=1.0),
+        component(options.suep, suep_eta, suep_phi, 0.7, 2.5),
+    ]
+    fields = {
+        f: ak.concatenate([c[f] for c in components], axis=1)
+        for f in ["pt", "eta", "phi"]
+    }
+    fields["mass"] = ak.full_like(fields["pt"], 0.13957)
+    return ak.zip(fields, with_name="Momentum4D")
+
+
+def measure(stage, nevents, ntracks, func, *args):
+    """
+    Runs func(*args) once under tracemalloc, for the peak memory of the numpy and
+    python allocations (not the ones made inside fastjet or torch), then times it
+    options.repeat times. Returns the result of the first run.
+    """
+    tracemalloc.start()
+    result = func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times = []
+    for _ in range(options.repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+
+    median = float(np.median(times))
+    results.append(
+        {
+            "stage": stage,
+            "chunksize": nevents,
+            "ntracks": ntracks,
+            "times": times,
+            "median": median,
+            "events_per_s": nevents / median if median else 0,
+            "peak_mb": peak / 1024**2,
+        }
+    )
+    print(
+        "{:<16} {:>8} {:>10.4f} {:>14.0f} {:>12.1f}".format(
+            stage, nevents, median, results[-1]["events_per_s"], peak / 1024**2
+        )
+    )
+    return result
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=repo_dir, text=True
+        ).strip()
+        dirty = subprocess.check_output(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=repo_dir,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(dirty)
+
+
+def package_versions():
+    """Versions of the packages the stages depend on, None if not installed."""
+    versions = {}
+    for package in [
+        "numpy",
+        "awkward",
+        "vector",
+        "fastjet",
+        "coffea",
+        "torch",
+        "torch_geometric",
+        "onnxruntime",
+    ]:
+        try:
+            versions[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def compare(report, path):
+    with open(path) as f:
+        reference = json.load(f)
+    medians = {(r["stage"], r["chunksize"]): r["median"] for r in reference["results"]}
+    print(f"\nComparison to {path} (commit {reference['commit']})")
+    # versions of the packages, which can explain the differences in time
+    ref_versions = reference.get("versions", {})
+    for package, version in report["versions"].items():
+        if ref_versions.get(package) != version:
+            print(f"N.B.: {package} {ref_versions.get(package)} -> {version}")
+    print(
+        "{:<16} {:>8} {:>10} {:>10} {:>8}".format(
+            "stage", "events", "ref [s]", "this [s]", "ratio"
+        )
+    )
+    for r in report["results"]:
+        ref = medians.get((r["stage"], r["chunksize"]))
+        if ref is None:
+            continue
+        print(
+            "{:<16} {:>8} {:>10.4f} {:>10.4f} {:>8.2f}".format(
+                r["stage"], r["chunksize"], ref, r["median"], r["median"] / ref
+            )
+        )
+
+
+processor = SimpleNamespace(
+    era=options.era, scouting=0, batch_size=1024, obj="bPFcand", coords="cyl"
+)
+model = None
+if "gnn" in options.stages:
+    try:
+        model = ML_utils.get_GNN_model(
+            options.model, options.config, modelDir=os.path.join(repo_dir, "data/GNN/")
+        )
+    except (AttributeError, ImportError) as e:
+        # ML_utils is None, or torch_geometric misses an optional dependency
+        print(f"Skipping the gnn stage: {e}")
+
+results = []
+print(
+    "{:<16} {:>8} {:>10} {:>14} {:>12}".format(
+        "stage", "events", "median [s]", "events / s", "peak [MB]"
+    )
+)
+for chunksize in options.chunksizes:
+    rng = np.random.default_rng(options.seed)
+    tracks = make_tracks(chunksize, rng)
+    ntracks = int(ak.sum(ak.num(tracks)))
+
+    if "track_killing" in options.stages:
+        measure(
+            "track_killing",
+            chunksize,
+            ntracks,
+            track_killing,
+            processor,
+            tracks,
+            np.random.default_rng(options.seed),
+        )
+
+    if "sphericity" in options.stages:
+        measure("sphericity", chunksize, ntracks, SUEP_utils.sphericity, tracks, 1.0)
+
+    # the other stages run on the output of the clustering
+    if not set(options.stages) & {"fastjet", "top_two_jets", "convert_coords", "gnn"}:
+        continue
+    if "fastjet" in options.stages:
+        jets, cluster = measure(
+            "fastjet",
+            chunksize,
+            ntracks,
+            SUEP_utils.FastJetReclustering,
+            tracks,
+            1.5,
+            150,
+        )
+    else:
+        jets, cluster = SUEP_utils.FastJetReclustering(tracks, r=1.5, minPt=150)
+
+    # at least 2 jets, as in the analysis
+    clusterCut = ak.num(jets, axis=1) > 1
+    jets, cluster, tracks = jets[clusterCut], cluster[clusterCut], tracks[clusterCut]
+    indices = np.arange(len(tracks))
+    if len(tracks) == 0:
+        print(f"No events with 2 jets in the chunk of {chunksize} events")
+        continue
+
+    def top_two_jets():
+        return SUEP_utils.getTopTwoJets(processor, tracks, indices, jets, cluster)
+
+    if "top_two_jets" in options.stages:
+        _, _, topTwoJets = measure("top_two_jets", chunksize, ntracks, top_two_jets)
+    else:
+        _, _, topTwoJets = top_two_jets()
+    SUEP_cand, ISR_cand, SUEP_cluster_tracks, ISR_cluster_tracks = topTwoJets
+
+    if "convert_coords" in options.stages:
+        measure(
+            "convert_coords",
+            chunksize,
+            ntracks,
+            SUEP_utils.convert_coords,
+            "cyl",
+            SUEP_cluster_tracks,
+            options.nobj,
+        )
+
+    if model is not None:
+        measure(
+            "gnn",
+            chunksize,
+            ntracks,
+            ML_utils.run_inference_GNN,
+            processor,
+            model,
+            SUEP_cluster_tracks,
+            SUEP_cand,
+        )
+
+commit, dirty = git_commit()
+report = {
+    "commit": commit,
+    "dirty": dirty,
+    "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+    "host": platform.node(),
+    "python": platform.python_version(),
+    "versions": package_versions(),
+    "options": vars(options),
+    "results": results,
+}
+with open(options.output, "w") as f:
+    json.dump(report, f, indent=2)
+print(f"Results written to {options.output}")
+
+if options.compare:
+    compare(report, options.compare)
@@ -0,0 +1,102 @@
+"""
+Compare the flattened track killing in workflows/CMS_corrections/track_killing_utils.py
+to the previous per-event loop, on synthetic tracks.
+Run from the top of the repository:
+    python additional_tools/benchmarks/benchmark_track_killing.py --nevents 10000
+"""
+import argparse
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import awkward as ak
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "../.."))
+from workflows.CMS_corrections.track_killing_utils import track_killing
+
+parser = argparse.ArgumentParser(description="Track killing benchmark")
+parser.add_argument("--nevents", type=int, default=10000, help="events per chunk")
+parser.add_argument("--ntracks", type=float, default=150, help="mean tracks/event")
+parser.add_argument("--era", type=int, default=2018, help="era")
+parser.add_argument("--seed", type=int, default=42, help="random seed")
+options = parser.parse_args()
+
+
+def track_killing_loop(self, tracks):
+    """The per-event implementation, kept here as a reference."""
+
+    if self.scouting:
+        block1_percent = 0.05
+        block2_percent = 0.01
+    else:
+        year_percent = {"2018": 0.021, "2017": 0.022, "2016": 0.027}
+        block1_percent = year_percent[str(self.era)]
+        block2_percent = 0.01
+
+    block1_indices = (tracks.pt > 1) & (tracks.pt < 20)
+    block2_indices = tracks.pt >= 20
+
+    new_indices = []
+    for i in range(len(tracks)):
+        event_indices = np.arange(len(tracks[i]))
+        event_bool = np.array([True] * len(tracks[i]))
+
+        block1_event_indices = event_indices[block1_indices[i]]
+        block1_event_indices_drop = np.random.choice(
+            block1_event_indices, int((block1_percent) * len(block1_event_indices))
+        )
+        event_bool[block1_event_indices_drop] = False
+
+        block2_event_indices = event_indices[block2_indices[i]]
+        block2_event_indices_drop = np.random.choice(
+            block2_event_indices, int((block2_percent) * len(block2_event_indices))
+        )
+        event_bool[block2_event_indices_drop] = False
+
+        new_indices.append(list(event_bool))
+
+    new_indices = ak.Array(new_indices)
+    tracks = tracks[new_indices]
+    return tracks
+
+
+def make_tracks(nevents, ntracks, rng):
+    counts = rng.poisson(ntracks, nevents)
+    pt = 0.75 + rng.exponential(2.0, counts.sum())
+    # a harder tail, so that the pT > 20 GeV block is populated
+    pt[rng.random(len(pt)) < 0.05] *= 10
+    return ak.zip({"pt": ak.unflatten(pt, counts)})
+
+
+def drop_fractions(before, after):
+    pt_before = ak.to_numpy(ak.flatten(before.pt))
+    pt_after = ak.to_numpy(ak.flatten(after.pt))
+    fractions = []
+    for lo, hi in [(1, 20), (20, np.inf)]:
+        n_before = np.sum((pt_before > lo) & (pt_before < hi))
+        n_after = np.sum((pt_after > lo) & (pt_after < hi))
+        fractions.append(1 - n_after / n_before)
+    return fractions
+
+
+rng = np.random.default_rng(options.seed)
+np.random.seed(options.seed)
+processor = SimpleNamespace(era=options.era, scouting=0)
+tracks = make_tracks(options.nevents, options.ntracks, rng)
+
+start = time.perf_counter()
+tracks_loop = track_killing_loop(processor, tracks)
+time_loop = time.perf_counter() - start
+
+start = time.perf_counter()
+tracks_flat = track_killing(processor, tracks, rng)
+time_flat = time.perf_counter() - start
+
+print(f"{options.nevents} events, {ak.sum(ak.num(tracks))} tracks")
+print(f"loop:      {time_loop:.3f} s")
+print(f"flattened: {time_flat:.3f} s ({time_loop / time_flat:.0f}x)")
+for label, killed in [("loop", tracks_loop), ("flattened", tracks_flat)]:
+    f1, f2 = drop_fractions(tracks, killed)
+    print(f"{label} drop fractions: 1 < pT < 20: {f1:.4f}, pT > 20: {f2:.4f}")
@@ -6,7 +6,7 @@ from coffea import processor
 from coffea.processor import Runner, futures_executor, run_uproot_job
 
 # SUEP Repo Specific
-from workflows import SUEP_coffea, merger
+from workflows import SUEP_coffea, branch_audit, merger
 
 # Begin argparse
 parser = argparse.ArgumentParser("")
@@ -17,7 +17,41 @@ parser.add_argument("--doSyst", type=int, default=1, help="")
 parser.add_argument("--infile", required=True, type=str, default=None, help="")
 parser.add_argument("--dataset", type=str, default="X", help="")
 parser.add_argument("--nevt", type=str, default=-1, help="")
+parser.add_argument(
+    "--boundedMerge",
+    type=int,
+    default=0,
+    help="Merge the chunks one at a time into an on-disk table, to bound the memory",
+)
 parser.add_argument("--doInf", type=int, default=0, help="")
+parser.add_argument(
+    "--jecCache", type=str, default=None, help="Directory to cache the JEC evaluators"
+)
+parser.add_argument(
+    "--format",
+    type=str,
+    default="hdf5",
+    choices=["hdf5", "parquet"],
+    help="Output format of the ntuples",
+)
+parser.add_argument(
+    "--auditBranches",
+    type=str,
+    default=None,
+    help="Write the branches and bytes read by the processor to this json report",
+)
+parser.add_argument(
+    "--preloadBranches",
+    type=str,
+    default=None,
+    help="Read the branches of a report from --auditBranches at once for each chunk",
+)
+parser.add_argument(
+    "--profile",
+    type=int,
+    default=0,
+    help="Print the time and memory of each stage of the processor",
+)
 options = parser.parse_args()
 
 out_dir = os.getcwd()
@@ -35,7 +69,14 @@ modules_era.append(
         flag=False,
         do_inf=options.doInf,
         output_location=out_dir,
-        accum="pandas_merger",
+        preload_branches=(
+            branch_audit.read_branches(options.preloadBranches)
+            if options.preloadBranches
+            else None
+        ),
+        profile=bool(options.profile),
+        accum="parquet_merger" if options.format == "parquet" else "pandas_merger",
+        jec_cache_dir=options.jecCache,
     )
 )
 
@@ -46,9 +87,10 @@ for instance in modules_era:
         schema=processor.NanoAODSchema,
         xrootdtimeout=60,
         chunksize=10000,
+        savemetrics=bool(options.auditBranches),
     )
 
-    runner.automatic_retries(
+    out = runner.automatic_retries(
         retries=3,
         skipbadfiles=False,
         func=runner.run,
@@ -57,4 +99,17 @@ for instance in modules_era:
         processor_instance=instance,
     )
 
-    merger.merge(options, pattern="condor_*.hdf5", outFile="out.hdf5")
+    if options.auditBranches:
+        branch_audit.write_report(
+            out["metrics"], options.auditBranches, fileset=[options.infile]
+        )
+
+    if options.format == "parquet":
+        merger.merge_parquet(options, pattern="condor_*.parquet", outFile="out.parquet")
+    else:
+        merger.merge(
+            options,
+            pattern="condor_*.hdf5",
+            outFile="out.hdf5",
+            bounded_memory=options.boundedMerge,
+        )
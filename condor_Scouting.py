@@ -7,7 +7,7 @@ from coffea import processor
 # Import coffea specific features
 from coffea.processor import futures_executor, run_uproot_job
 
-from workflows import SUEP_coffea, merger, root_rewrite
+from workflows import SUEP_coffea, branch_audit, merger, root_rewrite
 
 # Begin argparse
 parser = argparse.ArgumentParser("")
@@ -19,6 +19,30 @@ parser.add_argument("--doInf", type=int, default=0, help="")
 parser.add_argument("--infile", type=str, default=None, help="")
 parser.add_argument("--dataset", type=str, default="X", help="")
 parser.add_argument("--nevt", type=str, default=-1, help="")
+parser.add_argument(
+    "--boundedMerge",
+    type=int,
+    default=0,
+    help="Merge the chunks one at a time into an on-disk table, to bound the memory",
+)
+parser.add_argument(
+    "--auditBranches",
+    type=str,
+    default=None,
+    help="Write the branches and bytes read by the processor to this json report",
+)
+parser.add_argument(
+    "--preloadBranches",
+    type=str,
+    default=None,
+    help="Read the branches of a report from --auditBranches at once for each chunk",
+)
+parser.add_argument(
+    "--profile",
+    type=int,
+    default=0,
+    help="Print the time and memory of each stage of the processor",
+)
 options = parser.parse_args()
 
 out_dir = os.getcwd()
@@ -38,6 +62,12 @@ modules_era.append(
         flag=False,
         do_inf=options.doInf,
         output_location=out_dir,
+        preload_branches=(
+            branch_audit.read_branches(options.preloadBranches)
+            if options.preloadBranches
+            else None
+        ),
+        profile=bool(options.profile),
     )
 )
 
@@ -49,9 +79,10 @@ for instance in modules_era:
         schema=processor.NanoAODSchema,
         xrootdtimeout=60,
         chunksize=10000,
+        savemetrics=bool(options.auditBranches),
     )
 
-    runner.automatic_retries(
+    out = runner.automatic_retries(
         retries=3,
         skipbadfiles=False,
         func=runner.run,
@@ -60,6 +91,16 @@ for instance in modules_era:
         processor_instance=instance,
     )
 
-    merger.merge(options, pattern="condor_*.hdf5", outFile="out.hdf5")
+    if options.auditBranches:
+        branch_audit.write_report(
+            out["metrics"], options.auditBranches, fileset=[options.infile]
+        )
+
+    merger.merge(
+        options,
+        pattern="condor_*.hdf5",
+        outFile="out.hdf5",
+        bounded_memory=options.boundedMerge,
+    )
 
 os.system("rm rewrite.root")
@@ -30,8 +30,8 @@ sleep $[ ( $RANDOM % 1000 )  + 1 ]s
 pip install h5py
 
 echo "----- Found Proxy in: $X509_USER_PROXY"
-echo "python3 {condor_file} --jobNum=$1 --isMC={ismc} --era={era} --doInf={doInf} --doSyst={doSyst} --dataset={dataset} --infile=$2"
-python3 {condor_file} --jobNum=$1 --isMC={ismc} --era={era} --doInf={doInf} --doSyst={doSyst} --dataset={dataset} --infile=$2
+echo "python3 {condor_file} --jobNum=$1 --isMC={ismc} --era={era} --doInf={doInf} --doSyst={doSyst} --dataset={dataset} --infile=$2{extra_args}"
+python3 {condor_file} --jobNum=$1 --isMC={ismc} --era={era} --doInf={doInf} --doSyst={doSyst} --dataset={dataset} --infile=$2{extra_args}
 
 #echo "----- transferring output to scratch :"
 echo "xrdcp {outfile}.{file_ext} {redirector}/{outdir}/$3.{file_ext}"
@@ -108,6 +108,13 @@ def main():
     parser.add_argument(
         "-cutflow", "--cutflow", type=int, default=0, help="Cutflow analyzer."
     )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="hdf5",
+        choices=["hdf5", "parquet"],
+        help="Output format of the ntuples (SUEP workflow only).",
+    )
     parser.add_argument("-q", "--queue", type=str, default="espresso", help="")
     parser.add_argument("-e", "--era", type=str, default="2018", help="")
     parser.add_argument(
@@ -132,6 +139,7 @@ def main():
 
     # define which file you want to run, the output file name and extension that it produces
     # these will be transferred back to outdir/outdir_condor
+    extra_args = ""
     if options.scout == 1:
         condor_file = "condor_Scouting.py"
         outfile = "out"
@@ -147,7 +155,8 @@ def main():
     else:
         condor_file = "condor_SUEP_WS.py"
         outfile = "out"
-        file_ext = "hdf5"
+        file_ext = options.format
+        extra_args = f" --format={options.format}"
 
     # Making sure that the proxy is good
     lifetime = check_proxy(time_min=100)
@@ -232,6 +241,7 @@ def main():
                     condor_file=condor_file,
                     outfile=outfile,
                     file_ext=file_ext,
+                    extra_args=extra_args,
                     redirector=redirector,
                 )
                 scriptfile.write(script)
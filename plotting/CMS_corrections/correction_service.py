@@ -0,0 +1,119 @@
+import os
+
+import numpy as np
+from CMS_corrections import higgs_reweight, pileup_weight, triggerSF
+
+# correction tables, loaded once per process
+_tables = {}
+
+
+class LookupTable:
+    """
+    Binned correction, with the nominal, up and down weights of each bin.
+    edges: bin edges, the bin of each value is found with np.digitize. If None,
+           the values (truncated to int) are the bin indices.
+    clip: put the values outside of the edges in the first/last bins.
+    """
+
+    variations = ["nominal", "up", "down"]
+
+    def __init__(self, edges, nominal, up, down, clip=False):
+        self.edges = None if edges is None else np.asarray(edges)
+        self.weights = np.stack([nominal, up, down])
+        self.clip = clip
+
+    def bins(self, values):
+        values = np.asarray(values).astype(int)
+        if self.edges is None:
+            return values
+        bins = np.digitize(values, self.edges) - 1
+        if self.clip:
+            bins = np.clip(bins, 0, self.weights.shape[1] - 1)
+        return bins
+
+    def lookup(self, values, variation="nominal"):
+        """
+        Weights of the values for a variation ("nominal", "up" or "down"), or for
+        a list of variations, as an array of dimensions (variations x values).
+        """
+        bins = self.bins(values)
+        if isinstance(variation, str):
+            return self.weights[self.variations.index(variation)][bins]
+        rows = [self.variations.index(v) for v in variation]
+        return self.weights[rows][:, bins]
+
+    def save(self, path):
+        # write to a temporary file first, so parallel jobs never read a partial table
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            edges=np.array([]) if self.edges is None else self.edges,
+            direct=self.edges is None,
+            weights=self.weights,
+            clip=self.clip,
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as table:
+            edges = None if table["direct"] else table["edges"]
+            return cls(edges, *table["weights"], clip=bool(table["clip"]))
+
+
+def cached_table(key, sources, cache_path, make_table):
+    """
+    Returns the table key, from memory, from the .npz cache_path if it is newer
+    than all the sources, or else built with make_table() and then cached.
+    """
+    if key in _tables:
+        return _tables[key]
+
+    if os.path.exists(cache_path) and all(
+        os.path.getmtime(cache_path) >= os.path.getmtime(s) for s in sources
+    ):
+        table = LookupTable.load(cache_path)
+    else:
+        table = make_table()
+        try:
+            table.save(cache_path)
+        except OSError:
+            # e.g. read-only data directory, the table is still cached in memory
+            pass
+
+    _tables[key] = table
+    return table
+
+
+def get_pileup_table(era):
+    """Pileup weights, looked up by Pileup_nTrueInt."""
+    return cached_table(
+        ("pileup", era),
+        pileup_weight.pileup_files[era],
+        f"../data/pileup/pileup_weights_UL{era}.npz",
+        lambda: LookupTable(None, *pileup_weight.pileup_weight(era)),
+    )
+
+
+def get_trigSF_table(era):
+    """Trigger scale factors, looked up by ht. Overflows get the last SF."""
+
+    def make_table():
+        bins, weights, weights_up, weights_down = triggerSF.triggerSF(era)
+        return LookupTable(bins, weights, weights_up, weights_down, clip=True)
+
+    return cached_table(
+        ("trigSF", era),
+        [triggerSF.trigSF_files[era]],
+        f"../data/trigSF/trigSF_{era}.npz",
+        make_table,
+    )
+
+
+def get_higgs_table(gen_pt):
+    """
+    Higgs pT weights, looked up by SUEP_genPt. Not cached: they are normalized
+    to the gen pT distribution of the sample, gen_pt.
+    """
+    bins, weights, weights_up, weights_down = higgs_reweight.higgs_reweight(gen_pt)
+    return LookupTable(bins, weights, weights_up, weights_down)
@@ -1,4 +1,3 @@
-import matplotlib.pyplot as plt
 import numpy as np
 
 
@@ -98,7 +97,7 @@ def higgs_reweight(gen_pt):
         ]
     )
 
-    vals = plt.hist(gen_pt, bins=bins)
+    vals = np.histogram(gen_pt, bins=bins)
 
     freqs = vals[0] * Higgs_factor
     ups = freqs * up_factor
@@ -1,23 +1,26 @@
 import numpy as np
 import uproot
 
+pileup_files = {
+    2016: (
+        "../data/pileup/mcPileupUL2016.root",
+        "../data/pileup/PileupHistogram-UL2016-100bins_withVar.root",
+    ),
+    2017: (
+        "../data/pileup/mcPileupUL2017.root",
+        "../data/pileup/PileupHistogram-UL2017-100bins_withVar.root",
+    ),
+    2018: (
+        "../data/pileup/mcPileupUL2018.root",
+        "../data/pileup/PileupHistogram-UL2018-100bins_withVar.root",
+    ),
+}
+
 
 def pileup_weight(era):
-    if era == 2018:
-        f_MC = uproot.open("../data/pileup/mcPileupUL2018.root")
-        f_data = uproot.open(
-            "../data/pileup/PileupHistogram-UL2018-100bins_withVar.root"
-        )
-    elif era == 2017:
-        f_MC = uproot.open("../data/pileup/mcPileupUL2017.root")
-        f_data = uproot.open(
-            "../data/pileup/PileupHistogram-UL2017-100bins_withVar.root"
-        )
-    elif era == 2016:
-        f_MC = uproot.open("../data/pileup/mcPileupUL2016.root")
-        f_data = uproot.open(
-            "../data/pileup/PileupHistogram-UL2016-100bins_withVar.root"
-        )
+    if era in pileup_files:
+        f_MC = uproot.open(pileup_files[era][0])
+        f_data = uproot.open(pileup_files[era][1])
     else:
         print(
             "no pileup weights because no year was selected for function pileup_weight"
@@ -1,14 +1,16 @@
 import numpy as np
 import uproot
 
+trigSF_files = {
+    2016: "../data/trigSF/trigSF_2016.root",
+    2017: "../data/trigSF/trigSF_2017.root",
+    2018: "../data/trigSF/trigSF_2018.root",
+}
+
 
 def triggerSF(era):
-    if era == 2018:
-        f_weight = uproot.open("../data/trigSF/trigSF_2018.root")
-    elif era == 2017:
-        f_weight = uproot.open("../data/trigSF/trigSF_2017.root")
-    elif era == 2016:
-        f_weight = uproot.open("../data/trigSF/trigSF_2016.root")
+    if era in trigSF_files:
+        f_weight = uproot.open(trigSF_files[era])
     else:
         print("no TriggerSFs because no year was selected for function triggerSF")
 
@@ -1,5 +1,8 @@
+import hashlib
 import json
 import logging
+import os
+import pickle
 import sys
 from collections import defaultdict
 from copy import deepcopy
@@ -9,12 +12,28 @@ import pandas as pd
 
 
 # load hdf5 with pandas
-def h5load(ifile, label):
+def h5load(ifile, label, columns=None):
+    """
+    columns: list of columns to keep (all if None). Only these are read from
+             table-format files; legacy fixed-format files are read in full
+             and then projected.
+    """
     try:
         with pd.HDFStore(ifile, "r") as store:
             try:
-                data = store[label]
-                metadata = store.get_storer(label).attrs.metadata
+                storer = store.get_storer(label)
+                metadata = storer.attrs.metadata
+                if columns is not None and storer.is_table:
+                    present = [
+                        c
+                        for c in storer.non_index_axes[0][1]
+                        if c in columns or c == "empty"
+                    ]
+                    data = store.select(label, columns=present)
+                else:
+                    data = store[label]
+                    if columns is not None and "empty" not in data.columns:
+                        data = data[[c for c in columns if c in data.columns]]
                 return data, metadata
 
             except KeyError:
@@ -25,6 +44,114 @@ def h5load(ifile, label):
         return 0, 0
 
 
+# load parquet with pyarrow, reading only the requested columns and rows
+def parquet_load(ifile, columns=None, filters=None):
+    """
+    Loads a Parquet file written by pandas_utils.save_parquet.
+    columns: list of columns to read (all if None); those missing from the file
+             are skipped.
+    filters: list of (variable, operator, value) selections, applied while reading
+             (predicate pushdown); those on columns missing from the file are skipped.
+    Returns the DataFrame and the metadata dictionary, as h5load.
+    """
+    import pyarrow.parquet as pq
+
+    try:
+        schema = pq.read_schema(ifile)
+        metadata = json.loads(schema.metadata[b"metadata"])
+
+        # files with no events
+        if "empty" in schema.names:
+            return pd.DataFrame(["empty"], columns=["empty"]), metadata
+
+        if columns is not None:
+            columns = [c for c in columns if c in schema.names]
+        if filters is not None:
+            filters = [f for f in filters if f[0] in schema.names] or None
+
+        data = pq.read_table(
+            ifile, columns=columns, filters=filters, memory_map=True
+        ).to_pandas()
+        return data, metadata
+
+    except BaseException:
+        print("Some error occurred", ifile)
+        return 0, 0
+
+
+# load either format, based on the file extension
+def load(ifile, label="vars", columns=None, filters=None):
+    if ifile.endswith(".parquet"):
+        return parquet_load(ifile, columns=columns, filters=filters)
+    return h5load(ifile, label, columns=columns)
+
+
+def get_required_columns(config, output, weight_columns=()):
+    """
+    Columns of the input files needed to make the outputs: the ABCD variables,
+    signal regions and selections of each entry of config, the variables of the
+    histograms in output (as matched by FillPlan),
+    and the inputs of the event weights.
+    This is a superset: columns missing from a file are skipped when reading.
+    """
+    columns = set(weight_columns)
+    for label_out, config_out in config.items():
+        input_method = config_out["input_method"]
+        columns.update([config_out["xvar"], config_out["yvar"]])
+        for key in ["SR", "SR2", "selections"]:
+            columns.update(sel[0] for sel in config_out.get(key, []))
+
+        for key in output.keys():
+            if not key.endswith("_" + label_out):
+                continue
+            name = key[: -len("_" + label_out)]
+            if name.startswith("2D_"):
+                names = name[len("2D_") :].split("_vs_")
+            else:
+                # with and without the ABCD region prefix, e.g. "A_"
+                names = [name]
+                if name[1:2] == "_" and name[0].isupper():
+                    names.append(name[2:])
+            # event wide variables, and method variables
+            for var in names:
+                columns.update([var, var + "_" + input_method])
+
+    columns.discard("")
+    return sorted(columns)
+
+
+def get_common_filters(config):
+    """
+    Selections shared by all the entries of config, in the format of the
+    Parquet filters. Pre-selecting the events with these when reading the
+    file does not change the output of any entry.
+    """
+    operators = {
+        "greater than": ">",
+        "gt": ">",
+        ">": ">",
+        "greater than or equal to": ">=",
+        ">=": ">=",
+        "less than": "<",
+        "lt": "<",
+        "<": "<",
+        "less than or equal to": "<=",
+        "<=": "<=",
+        "equal to": "==",
+        "eq": "==",
+        "==": "==",
+    }
+    common = None
+    for config_out in config.values():
+        selections = {
+            (var, operators[op], value)
+            for var, op, value in config_out["selections"]
+            if op in operators
+        }
+        common = selections if common is None else common & selections
+    return sorted(common or [])
+
+
 def getXSection(dataset, year, SUEP=False, path="../data/"):
     xsection = 1
     if not SUEP:
@@ -103,6 +230,7 @@ def apply_scaling_weights(
     x_var="SUEP_S1_CL",
     y_var="SUEP_nconst_CL",
     z_var="ht",
+    weight_columns=("event_weight",),
 ):
     """
     df: input DataFrame to scale
@@ -110,41 +238,38 @@ def apply_scaling_weights(
     scaling_weights: nested dictionary, region x (bins or ratios)
     regions: string of ordered regions, used to apply corrections
     *_var: x/y are of the ABCD plane, z of the scaling histogram
+    weight_columns: columns of event weights to scale
     """
 
-    x_var_regions = abcd["x_var_regions"]
-    y_var_regions = abcd["y_var_regions"]
-    iRegion = 0
-
-    # S1 regions
-    for i in range(len(x_var_regions) - 1):
-        x_val_lo = x_var_regions[i]
-        x_val_hi = x_var_regions[i + 1]
-
-        # nconst regions
-        for j in range(len(y_var_regions) - 1):
-            y_val_lo = y_var_regions[j]
-            y_val_hi = y_var_regions[j + 1]
-
-            r = regions[iRegion]
+    x_var_regions = abcd["xvar_regions"]
+    y_var_regions = abcd["yvar_regions"]
+    nx, ny = len(x_var_regions) - 1, len(y_var_regions) - 1
+
+    # lookup table of the ratios, (region x z bin), on the union of the z bins
+    # of all the regions: each of its bins is inside one bin of every region
+    region_bins = [np.asarray(scaling_weights[r]["bins"]) for r in regions[: nx * ny]]
+    edges = np.unique(np.concatenate(region_bins))
+    table = np.ones((nx * ny, max(len(edges) - 1, 0)))
+    for iRegion, bins in enumerate(region_bins):
+        ratios = scaling_weights[regions[iRegion]]["ratios"]
+        k = np.digitize(edges[:-1], bins) - 1
+        in_bins = (k >= 0) & (k < len(bins) - 1)
+        table[iRegion, in_bins] = np.asarray(ratios)[k[in_bins]]
+
+    # region (S1 x nconst) and z bin (ht) of each event, the events outside of
+    # them are not scaled
+    x_bin = np.digitize(df[x_var].to_numpy(), x_var_regions) - 1
+    y_bin = np.digitize(df[y_var].to_numpy(), y_var_regions) - 1
+    z_bin = np.digitize(df[z_var].to_numpy(), edges) - 1
+    in_table = (x_bin >= 0) & (x_bin < nx) & (y_bin >= 0) & (y_bin < ny)
+    in_table &= (z_bin >= 0) & (z_bin < len(edges) - 1)
+
+    ratio = np.ones(df.shape[0])
+    region = x_bin[in_table] * ny + y_bin[in_table]
+    ratio[in_table] = table[region, z_bin[in_table]]
+    for column in weight_columns:
+        df[column] = df[column].to_numpy() * ratio
 
-            # from the weights
-            bins = scaling_weights[r]["bins"]
-            ratios = scaling_weights[r]["ratios"]
-
-            # ht bins
-            for k in range(len(bins) - 1):
-                z_val_lo = bins[k]
-                z_val_hi = bins[k + 1]
-                ratio = ratios[k]
-
-                zslice = (df[z_var] >= z_val_lo) & (df[z_var] < z_val_hi)
-                yslice = (df[y_var] >= y_val_lo) & (df[y_var] < y_val_hi)
-                xslice = (df[x_var] >= x_val_lo) & (df[x_var] < x_val_hi)
-
-                df.loc[xslice & yslice & zslice, "event_weight"] *= ratio
-
-            iRegion += 1
     return df
 
 
@@ -180,126 +305,244 @@ def prepareDataFrame(df, abcd, label_out, blind=True, isMC=False):
     return df
 
 
-def fill_2d_distributions(df, output, label_out, input_method):
-    keys = list(output.keys())
-    keys_2Dhists = [k for k in keys if "2D" in k]
-    df_keys = list(df.keys())
-
-    for key in keys_2Dhists:
-        if not key.endswith(label_out):
-            continue
-        string = key[
-            len("2D") + 1 : -(len(label_out) + 1)
-        ]  # cut out "2D_" and output label
-        var1 = string.split("_vs_")[0]
-        var2 = string.split("_vs_")[1]
-        if var1 not in df_keys:
-            var1 += "_" + input_method
-            if var1 not in df_keys: 
-                continue
-        if var2 not in df_keys:
-            var2 += "_" + input_method
-            if var2 not in df_keys: 
-                continue
-        output[key].fill(df[var1], df[var2], weight=df["event_weight"])
+# fill plans of auto_fill, [columns, plan] compiled once per label and input columns
+_fill_plans = {}
 
 
-def auto_fill(df, output, abcd, label_out, isMC=False, do_abcd=False):
+class FillPlan:
+    """
+    Histograms of an output filled by auto_fill, matched once to the columns of
+    the input dataframes they are filled from:
+    hists_1d: (column, histogram) of the event wide and method variables,
+    hists_2d: (x column, y column, histogram) of the 2D distributions,
+    hists_regions: (region index, column, histogram) of the ABCD regions,
+    unmatched: histograms of the output not filled from any column.
+    """
 
+    regions = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+    def __init__(self, df_keys, output_keys, label_out, input_method, n_regions=0):
+        keys = set(output_keys)
+        df_keys = list(df_keys)
+        df_key_set = set(df_keys)
+
+        # event wide variables, e.g. ht -> ht_label
+        self.hists_1d = [
+            (key, key + "_" + label_out)
+            for key in df_keys
+            if key + "_" + label_out in keys
+        ]
+        # method variables, e.g. SUEP_pt_CL -> SUEP_pt_label
+        self.hists_1d += [
+            (key, key.replace(input_method, label_out))
+            for key in df_keys
+            if key.replace(input_method, label_out) in keys
+            and key.endswith(input_method)
+        ]
+
+        # 2D distributions, 2D_var1_vs_var2_label, from var or var_input_method
+        self.hists_2d = []
+        for key in output_keys:
+            if "2D" not in key or not key.endswith(label_out):
+                continue
+            string = key[len("2D") + 1 : -(len(label_out) + 1)]
+            variables = []
+            for var in string.split("_vs_")[:2]:
+                if var not in df_key_set:
+                    var += "_" + input_method
+                variables.append(var)
+            if all(var in df_key_set for var in variables):
+                self.hists_2d.append((*variables, key))
+
+        # the 1D histograms of each ABCD region, e.g. A_ht_label
+        self.hists_regions = [
+            (iRegion, column, self.regions[iRegion] + "_" + name)
+            for iRegion in range(n_regions)
+            for column, name in self.hists_1d
+            if self.regions[iRegion] + "_" + name in keys
+        ]
+
+        filled = {h[-1] for h in self.hists_1d + self.hists_2d + self.hists_regions}
+        self.unmatched = [
+            key
+            for key in output_keys
+            if key.endswith("_" + label_out) and key not in filled
+            # region histograms are only filled with do_abcd
+            and (n_regions > 0 or not (key[1:2] == "_" and key[0].isupper()))
+        ]
+
+
+def get_fill_plan(df, output, abcd, label_out, do_abcd=False):
+    """
+    Returns the FillPlan of output label_out for the columns of df, compiled
+    the first time they are seen, and reused for every file and systematic.
+    The histograms of a label are the same in every output, so the plans are
+    looked up by label and by the columns of df: first by identity of the column
+    index, which all the systematics of a file share, then by equality.
+    """
     input_method = abcd["input_method"]
+    n_regions = 0
+    if do_abcd:
+        n_regions = (len(abcd["xvar_regions"]) - 1) * (len(abcd["yvar_regions"]) - 1)
+
+    plans = _fill_plans.setdefault((label_out, input_method, n_regions), [])
+    for entry in plans:
+        if entry[0] is df.columns:
+            return entry[1]
+    for entry in plans:
+        if entry[0].equals(df.columns):
+            entry[0] = df.columns
+            return entry[1]
+
+    output_keys = [key for key in output.keys() if label_out in key]
+    plan = FillPlan(df.columns, output_keys, label_out, input_method, n_regions)
+    if len(plan.unmatched) > 0:
+        logging.debug(
+            f"{label_out}: histograms not filled from any column: "
+            + ", ".join(plan.unmatched)
+        )
+    plans.append([df.columns, plan])
+
+    return plan
+
+
+def auto_fill(
+    df, output, abcd, label_out, isMC=False, do_abcd=False, weight="event_weight"
+):
+    """
+    Fills all the histograms of output ending with label_out from df,
+    using the column weight as the event weights.
+    """
 
     #####################################################################################
     # ---- Fill Histograms
     # Automatically fills all histograms that are declared in the output dict.
     #####################################################################################
 
+    plan = get_fill_plan(df, output, abcd, label_out, do_abcd=do_abcd)
+
     # 1. fill the distributions as they are saved in the dataframes
-    # 1a. Plot event wide variables
-    event_plot_labels = [
-        key for key in df.keys() if key + "_" + label_out in list(output.keys())
-    ]
-    for plot in event_plot_labels:
-        output[plot + "_" + label_out].fill(df[plot], weight=df["event_weight"])
-
-    # 1b. Plot method variables
-    method_plot_labels = [
-        key
-        for key in df.keys()
-        if key.replace(input_method, label_out) in list(output.keys())
-        and key.endswith(input_method)
-    ]
-    for plot in method_plot_labels:
-        output[plot.replace(input_method, label_out)].fill(
-            df[plot], weight=df["event_weight"]
-        )
+    # event wide variables, and method variables
+    for column, name in plan.hists_1d:
+        output[name].fill(df[column], weight=df[weight])
 
     # 2. fill some 2D distributions
-    fill_2d_distributions(df, output, label_out, input_method)
+    for column_x, column_y, name in plan.hists_2d:
+        output[name].fill(df[column_x], df[column_y], weight=df[weight])
 
     # 3. divide the dfs by region
     if do_abcd:
-        regions = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-        xvar = abcd["xvar"]
-        yvar = abcd["yvar"]
         xvar_regions = abcd["xvar_regions"]
         yvar_regions = abcd["yvar_regions"]
-        iRegion = 0
-        for i in range(len(xvar_regions) - 1):
-            x_val_lo = xvar_regions[i]
-            x_val_hi = xvar_regions[i + 1]
-
-            for j in range(len(yvar_regions) - 1):
-
-                r = regions[iRegion] + "_"
-
-                y_val_lo = yvar_regions[j]
-                y_val_hi = yvar_regions[j + 1]
-
-                x_cut = make_selection(
-                    df, xvar, ">=", x_val_lo, False
-                ) & make_selection(df, xvar, "<", x_val_hi, False)
-                y_cut = make_selection(
-                    df, yvar, ">=", y_val_lo, False
-                ) & make_selection(df, yvar, "<", y_val_hi, False)
-                df_r = df.loc[(x_cut & y_cut)]
-
-                # double check the region is defined correctly
-                assert (
-                    df_r[
-                        (df_r[xvar] > float(x_val_hi)) | (df_r[xvar] < float(x_val_lo))
-                    ].shape[0]
-                    == 0
-                )
+        nx, ny = len(xvar_regions) - 1, len(yvar_regions) - 1
+
+        # region index of each event, iRegion = i * ny + j for the
+        # xvar_regions[i] <= xvar < xvar_regions[i+1] and similarly for yvar,
+        # or -1 if outside all the regions
+        x_bin = np.digitize(df[abcd["xvar"]].to_numpy(), xvar_regions) - 1
+        y_bin = np.digitize(df[abcd["yvar"]].to_numpy(), yvar_regions) - 1
+        in_regions = (x_bin >= 0) & (x_bin < nx) & (y_bin >= 0) & (y_bin < ny)
+        region = np.where(in_regions, x_bin * ny + y_bin, -1)
+
+        # group the events by region, keeping their order within each region
+        order = np.argsort(region, kind="stable")
+        region_size = np.bincount(region[in_regions], minlength=nx * ny)
+        region_start = np.count_nonzero(~in_regions) + np.cumsum(region_size)
+        region_start -= region_size
+
+        weights = df[weight].to_numpy()[order]
+        columns = {
+            column: df[column].to_numpy()[order] for _, column, _ in plan.hists_regions
+        }
+        for iRegion, column, name in plan.hists_regions:
+            start = region_start[iRegion]
+            stop = start + region_size[iRegion]
+            output[name].fill(columns[column][start:stop], weight=weights[start:stop])
+
+
+def add_histograms(plots, other):
+    """Adds the histograms of other to those with the same name in plots."""
+    for key, hist in other.items():
+        plots[key] = plots[key] + hist if key in plots else hist
+    return plots
+
+
+class TreeReduction:
+    """
+    Sums partial results as they arrive, pairing partials of the same size
+    (as in a binary counter), so only O(log n) partials are held at once and
+    each is summed O(log n) times.
+    """
+
+    def __init__(self, add=add_histograms):
+        self.add = add
+        self.stack = []  # (level, partial)
+
+    def push(self, partial):
+        level = 0
+        while self.stack and self.stack[-1][0] == level:
+            partial = self.add(self.stack.pop()[1], partial)
+            level += 1
+        self.stack.append((level, partial))
+
+    def result(self):
+        result = None
+        while self.stack:
+            partial = self.stack.pop()[1]
+            result = partial if result is None else self.add(partial, result)
+        return result
+
+
+# bump when the filling of the histograms changes, to invalidate the cached ones
+CACHE_VERSION = 1
+
+
+def file_hash(path, blocksize=1 << 20):
+    """Hash of the contents of a file, used to key its cached histograms."""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def config_hash(*objects):
+    """Hash of json-like objects (e.g. the config of an output)."""
+    objects = (CACHE_VERSION,) + objects
+    return hashlib.sha1(
+        json.dumps(objects, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class HistogramCache:
+    """
+    Partial histograms of each input file, pickled as
+    cache_dir/<file hash>/<key>.pkl, where the key is the hash of the config
+    of the output they belong to.
+    """
 
-                # double check blinding
-                if (
-                    iRegion == (len(xvar_regions) - 1) * (len(yvar_regions) - 1)
-                    and not isMC
-                ):
-                    if df_r.shape[0] > 0:
-                        sys.exit(
-                            label_out + ": You are not blinding correctly! Exiting."
-                        )
-
-                # 3a. Plot event wide variables
-                for plot in event_plot_labels:
-                    if r + plot + "_" + label_out not in list(output.keys()):
-                        continue
-                    output[r + plot + "_" + label_out].fill(
-                        df_r[plot], weight=df_r["event_weight"]
-                    )
-
-                # 3b. Plot method variables
-                for plot in method_plot_labels:
-                    if r + plot.replace(input_method, label_out) not in list(
-                        output.keys()
-                    ):
-                        continue
-                    output[r + plot.replace(input_method, label_out)].fill(
-                        df_r[plot], weight=df_r["event_weight"]
-                    )
-
-                iRegion += 1
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, fhash, key):
+        return os.path.join(self.cache_dir, fhash, key + ".pkl")
+
+    def load(self, fhash, key):
+        # None if not cached (or unreadable, e.g. from an interrupted run)
+        try:
+            with open(self.path(fhash, key), "rb") as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def save(self, fhash, key, value):
+        path = self.path(fhash, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, so parallel runs never read a partial pickle
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f)
+        os.replace(tmp_path, path)
 
 
 def apply_normalization(plots, norm):
@@ -2,22 +2,18 @@
 import argparse
 import getpass
 import logging
+import multiprocessing
 import os
 import pickle
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
 
 import fill_utils
 import numpy as np
 import uproot
 
 # Import our own functions
-from CMS_corrections import (
-    GNN_syst,
-    higgs_reweight,
-    pileup_weight,
-    track_killing,
-    triggerSF,
-)
+from CMS_corrections import GNN_syst, correction_service, track_killing
 from hist import Hist
 from tqdm import tqdm
 
@@ -77,6 +73,19 @@ parser.add_argument(
     default="None",
     help="Pass the filename of the weights, e.g. --weights weights.npy",
 )
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of processes filling the files of the dataset in parallel",
+)
+parser.add_argument(
+    "--cacheDir",
+    type=str,
+    default="",
+    help="Cache the histograms of each file and output here, and only refill those "
+    + "of new files or changed outputs (default: no caching)",
+)
 options = parser.parse_args()
 
 ###################################################################################################################
@@ -200,14 +209,20 @@ if options.doInf:
     )
 
 
-def open_file(options, redirector, ifile):
-    if not options.xrootd:
-        return fill_utils.h5load(ifile, "vars")
-    if os.path.exists(options.dataset + ".hdf5"):
-        os.system("rm " + options.dataset + ".hdf5")
-    xrd_file = redirector + ifile
-    os.system(f"xrdcp -s {xrd_file} {options.dataset}.hdf5")
-    return fill_utils.h5load(options.dataset + ".hdf5", "vars")
+def local_file(options, ifile):
+    # local copy of the file, when reading over xrootd (one per worker process)
+    return f"{options.dataset}_{os.getpid()}{os.path.splitext(ifile)[1]}"
+
+
+def fetch_file(options, redirector, ifile):
+    # path of the file to read, copied locally first when reading over xrootd
+    if options.xrootd:
+        if os.path.exists(local_file(options, ifile)):
+            os.remove(local_file(options, ifile))
+        xrd_file = redirector + ifile
+        os.system(f"xrdcp -s {xrd_file} {local_file(options, ifile)}")
+        ifile = local_file(options, ifile)
+    return ifile
 
 
 def create_output_clusterInverted(output, label, regions_list):
@@ -406,7 +421,7 @@ def create_output_GNNInverted(abcd, output, label, regions_list):
 
 
 # output histos
-def create_output_file(label, abcd):
+def create_output_file(output, label, abcd):
     # don't recreate histograms if called multiple times with the same output label
     if label in output["labels"]:
         return output
@@ -622,51 +637,45 @@ def create_output_file(label, abcd):
     return output
 
 
-def calculate_systematic(
-    df,
-    config,
-    syst,
-    options,
-):
-    # prepare new event weight
+def weight_column(syst):
+    # column of the event weights for each systematic
+    return "event_weight" + ("_" + syst if syst else "")
+
+
+def calculate_weights(df, sys_loop, options):
+    """
+    Computes the event weights of all the systematics in sys_loop at once,
+    stored in the columns weight_column(syst) of df.
+    """
+
+    # nominal and up/down variations of each weight, applied only to their systematic
+    nominal = np.ones(df.shape[0])
+    variations = {}
+
     if options.isMC:
-        df["event_weight"] = df['genweight'].to_numpy()
-    else:
-        df["event_weight"] = np.ones(df.shape[0])
+        nominal = nominal * df["genweight"].to_numpy()
 
     if options.isMC == 1:
 
         if options.scouting != 1:
 
             # 1) pileup weights
-            puweights, puweights_up, puweights_down = pileup_weight.pileup_weight(
-                options.era
+            pu = correction_service.get_pileup_table(options.era).lookup(
+                df["Pileup_nTrueInt"], ["nominal", "up", "down"]
             )
-            pu = pileup_weight.get_pileup_weights(
-                df, syst, puweights, puweights_up, puweights_down
-            )
-            df["event_weight"] *= pu
+            variations["pu"] = dict(zip(["", "puweights_up", "puweights_down"], pu))
 
             # 2) TriggerSF weights
-            (
-                trig_bins,
-                trig_weights,
-                trig_weights_up,
-                trig_weights_down,
-            ) = triggerSF.triggerSF(options.era)
-            trigSF = triggerSF.get_trigSF_weight(
-                df,
-                syst,
-                trig_bins,
-                trig_weights,
-                trig_weights_up,
-                trig_weights_down,
+            trigSF = correction_service.get_trigSF_table(options.era).lookup(
+                df["ht"], ["nominal", "up", "down"]
             )
-            df["event_weight"] *= trigSF
+            variations["trigSF"] = dict(zip(["", "trigSF_up", "trigSF_down"], trigSF))
 
             # 3) PS weights
-            if "PSWeight" in syst and syst in df.keys():
-                df["event_weight"] *= df[syst]
+            variations["PSWeight"] = {"": 1.0}
+            for syst in sys_loop:
+                if "PSWeight" in syst and syst in df.keys():
+                    variations["PSWeight"][syst] = df[syst].to_numpy()
 
             # 3) prefire weights
             # if options.era == 2016 or options.era == 2017:
@@ -677,63 +686,159 @@ def calculate_systematic(
 
         # 5) Higgs_pt weights
         if "SUEP-m125" in options.dataset:
-            (
-                higgs_bins,
-                higgs_weights,
-                higgs_weights_up,
-                higgs_weights_down,
-            ) = higgs_reweight.higgs_reweight(df["SUEP_genPt"])
-            higgs_weight = higgs_reweight.get_higgs_weight(
-                df,
-                syst,
-                higgs_bins,
-                higgs_weights,
-                higgs_weights_up,
-                higgs_weights_down,
+            higgs = correction_service.get_higgs_table(df["SUEP_genPt"]).lookup(
+                df["SUEP_genPt"], ["nominal", "up", "down"]
+            )
+            variations["higgs"] = dict(
+                zip(["", "higgs_weights_up", "higgs_weights_down"], higgs)
             )
-            df["event_weight"] *= higgs_weight
+
+    for syst in sys_loop:
+        weight = nominal
+        for variation in variations.values():
+            weight = weight * variation.get(syst, variation[""])
+        df[weight_column(syst)] = weight
 
     # 6) scaling weights
     # N.B.: these aren't part of the systematics, just an optional scaling
     if scaling_weights is not None:
         df = fill_utils.apply_scaling_weights(
-            df.copy(),
+            df,
             scaling_weights,
             config["Cluster"],
             regions="ABCDEFGHI",
             x_var="SUEP_S1_CL",
             y_var="SUEP_nconst_CL",
             z_var="ht",
+            weight_columns=[weight_column(syst) for syst in sys_loop],
         )
 
+    return df
+
+
+def fill_outputs(df, output, config, sys_loop, options):
+    """
+    Fills in output the histograms of all the outputs in config, for all the
+    systematics in sys_loop. The selections of each output are applied once, then the
+    histograms of each systematic are filled with its column of event weights.
+    """
+
     for label_out, config_out in config.items():
-        if "track_down" in label_out and syst != "":
-            continue  # don't run other systematics when doing track killing systematic
-        if options.isMC and syst != "":
-            if any([j in label_out for j in jet_corrections]):
-                continue  # don't run other systematics when doing jet systematics
-
-        # rename if we have applied a systematic
-        if len(syst) > 0:
-            label_out = label_out + "_" + syst
-
-        # initialize new hists, if needed
-        output.update(create_output_file(label_out, config_out))
-        
+
         # prepare the DataFrame for plotting: blind, selections
         df_plot = fill_utils.prepareDataFrame(
-            df.copy(), config_out, label_out, isMC=options.isMC, blind=options.blind
+            df, config_out, label_out, isMC=options.isMC, blind=options.blind
         )
+        if df_plot is None:
+            continue
+
+        for syst in sys_loop:
+            if "track_down" in label_out and syst != "":
+                continue  # don't run other systematics when doing track killing systematic
+            if options.isMC and syst != "":
+                if any([j in label_out for j in jet_corrections]):
+                    continue  # don't run other systematics when doing jet systematics
+
+            # rename if we have applied a systematic
+            label_syst = label_out
+            if len(syst) > 0:
+                label_syst = label_out + "_" + syst
+
+            # initialize new hists, if needed
+            create_output_file(output, label_syst, config_out)
+
+            # auto fill all histograms
+            fill_utils.auto_fill(
+                df_plot,
+                output,
+                config_out,
+                label_syst,
+                isMC=options.isMC,
+                do_abcd=options.doABCD,
+                weight=weight_column(syst),
+            )
 
-        # auto fill all histograms
-        fill_utils.auto_fill(
-            df_plot,
-            output,
-            config_out,
-            label_out,
-            isMC=options.isMC,
-            do_abcd=options.doABCD,
-        )
+
+def plot_file(ifile):
+    """
+    Fills the histograms of a single file, output by output, in new output
+    dictionaries. With --cacheDir, the histograms of the outputs already cached
+    for this file are loaded instead, and the new ones are cached.
+    Returns the histograms, the gensumweight of the file, and whether it failed
+    to be read.
+    """
+
+    #####################################################################################
+    # ---- Load file
+    #####################################################################################
+
+    # get the file
+    ifile = fetch_file(options, redirector, ifile)
+
+    # outputs of this file cached by previous runs
+    fhash = None
+    if cache is not None and os.path.exists(ifile):
+        fhash = fill_utils.file_hash(ifile)
+    cached, gensumweight = {}, None
+    if fhash is not None:
+        for label_out, key in cache_keys.items():
+            histograms = cache.load(fhash, key)
+            if histograms is not None:
+                cached[label_out] = histograms
+        gensumweight = cache.load(fhash, gensumweight_key)
+    missing = {
+        label_out: config_out
+        for label_out, config_out in config.items()
+        if label_out not in cached
+    }
+
+    histograms = {}
+    for label_histograms in cached.values():
+        histograms.update(label_histograms)
+
+    if len(missing) > 0 or gensumweight is None:
+
+        df, metadata = fill_utils.load(ifile, "vars", columns=columns, filters=filters)
+
+        # check if file is corrupted
+        if type(df) == int:
+            return {}, 0, True
+
+        # update the gensumweight
+        gensumweight = 0
+        if options.isMC and metadata != 0:
+            gensumweight = metadata["gensumweight"]
+
+        # check if file is empty
+        filled = {label_out: {} for label_out in missing}
+        if "empty" not in list(df.keys()) and df.shape[0] > 0:
+
+            # prepare the event weights of all the systematics, and fill the outputs
+            df = calculate_weights(df, sys_loop, options)
+            for label_out, config_out in missing.items():
+                label_output = {"labels": []}
+                fill_outputs(
+                    df, label_output, {label_out: config_out}, sys_loop, options
+                )
+                label_output.pop("labels")
+                filled[label_out] = label_output
+
+        for label_out, label_histograms in filled.items():
+            histograms.update(label_histograms)
+            if fhash is not None:
+                cache.save(fhash, cache_keys[label_out], label_histograms)
+        if fhash is not None:
+            cache.save(fhash, gensumweight_key, gensumweight)
+
+    #####################################################################################
+    # ---- End
+    #####################################################################################
+
+    # remove file at the end of loop
+    if options.xrootd and os.path.exists(ifile):
+        os.remove(ifile)
+
+    return histograms, gensumweight, False
 
 
 #############################################################################################################
@@ -791,69 +896,93 @@ if options.isMC and options.doSyst:
     config = config | new_config_jet_corrections
     config = config | new_config_track_killing
 
+if options.isMC and options.doSyst:
+    sys_loop = [
+        "",
+        "puweights_up",
+        "puweights_down",
+        "trigSF_up",
+        "trigSF_down",
+        "PSWeight_ISR_up",
+        "PSWeight_ISR_down",
+        "PSWeight_FSR_up",
+        "PSWeight_FSR_down",
+        "prefire_up",
+        "prefire_down",
+        "higgs_weights_up",
+        "higgs_weights_down",
+    ]
+else:
+    sys_loop = [""]
+
+# read only the columns needed for the histograms, selections and event weights
+for label_out, config_out in config.items():
+    create_output_file(output, label_out, config_out)
+weight_columns = [
+    "genweight",
+    "Pileup_nTrueInt",
+    "ht",
+    "SUEP_genPt",
+    "SUEP_S1_CL",
+    "SUEP_nconst_CL",
+] + sys_loop
+columns = fill_utils.get_required_columns(config, output, weight_columns)
+
+# selections common to all outputs, applied while reading Parquet files
+# N.B.: not for the Higgs pT reweighting, which is derived from all the events in the file
+filters = None
+if "SUEP-m125" not in options.dataset:
+    filters = fill_utils.get_common_filters(config)
+
+# cached histograms of each output, keyed by everything that changes them
+cache, cache_keys, gensumweight_key = None, {}, None
+if options.cacheDir:
+    cache = fill_utils.HistogramCache(options.cacheDir)
+    settings = {
+        key: getattr(options, key)
+        for key in [
+            "dataset",
+            "era",
+            "isMC",
+            "scouting",
+            "doSyst",
+            "doInf",
+            "doABCD",
+            "blind",
+        ]
+    }
+    if scaling_weights is not None:
+        settings["weights"] = fill_utils.file_hash(options.weights)
+    cache_keys = {
+        label_out: fill_utils.config_hash(label_out, config_out, sys_loop, settings)
+        for label_out, config_out in config.items()
+    }
+    gensumweight_key = fill_utils.config_hash("gensumweight", settings)
+
 logging.info("Setup ready, filling histograms now.")
 
 # Plotting loop #######################################################################
-for ifile in tqdm(files):
-
-    #####################################################################################
-    # ---- Load file
-    #####################################################################################
-
-    # get the file
-    df, metadata = open_file(options, redirector, ifile)
-
-    # check if file is corrupted
-    if type(df) == int:
-        nfailed += 1
-        continue
-
-    # update the gensumweight
-    if options.isMC and metadata != 0:
-        total_gensumweight += metadata["gensumweight"]
-
-    # check if file is empty
-    if "empty" in list(df.keys()):
-        continue
-    if df.shape[0] == 0:
-        continue
-
-    if options.isMC and options.doSyst:
-        sys_loop = [
-            "",
-            "puweights_up",
-            "puweights_down",
-            "trigSF_up",
-            "trigSF_down",
-            "PSWeight_ISR_up",
-            "PSWeight_ISR_down",
-            "PSWeight_FSR_up",
-            "PSWeight_FSR_down",
-            "prefire_up",
-            "prefire_down",
-            "higgs_weights_up",
-            "higgs_weights_down",
-        ]
-    else:
-        sys_loop = [""]
-
-    for syst in sys_loop:
-        # prepare new event weight
+# the histograms of each file are filled separately, in parallel with --workers > 1,
+# and summed in a tree reduction
+if options.workers > 1:
+    pool = ProcessPoolExecutor(
+        options.workers, mp_context=multiprocessing.get_context("fork")
+    )
+    results = pool.map(plot_file, files)
+else:
+    pool = None
+    results = map(plot_file, files)
 
-        calculate_systematic(
-            df,
-            config,
-            syst,
-            options
-        )
+reduction = fill_utils.TreeReduction()
+for histograms, gensumweight, failed in tqdm(results, total=len(files)):
+    nfailed += failed
+    total_gensumweight += gensumweight
+    reduction.push(histograms)
 
-    #####################################################################################
-    # ---- End
-    #####################################################################################
+if pool is not None:
+    pool.shutdown()
 
-    # remove file at the end of loop
-    if options.xrootd:
-        os.system("rm " + options.dataset + ".hdf5")
+output = fill_utils.add_histograms(output, reduction.result() or {})
 
 logging.warning("Number of files that failed to be read: " + str(nfailed))
 # End plotting loop ###################################################################
@@ -1,22 +1,97 @@
-from coffea import lumi_tools
+import json
+import os
+
+import awkward as ak
+import numpy as np
+
+golden_jsons = {
+    2016: "data/GoldenJSON/Cert_271036-284044_13TeV_Legacy2016_Collisions16_JSON.txt",
+    2017: "data/GoldenJSON/Cert_294927-306462_13TeV_UL2017_Collisions17_GoldenJSON.txt",
+    2018: "data/GoldenJSON/Cert_314472-325175_13TeV_Legacy2018_Collisions18_JSON.txt",
+}
+
+# lumi masks, built once per process for each golden json
+_lumi_masks = {}
+
+
+class CompactLumiMask:
+    """
+    Certified lumi sections of a golden json, stored as sorted arrays of the first
+    and last (run << 32 | luminosityBlock) of each certified range. An event passes
+    if its key falls in one of the ranges, found with np.searchsorted.
+    """
+
+    def __init__(self, starts, ends):
+        self.starts = np.asarray(starts, dtype=np.uint64)
+        self.ends = np.asarray(ends, dtype=np.uint64)
+
+    @staticmethod
+    def key(runs, lumis):
+        runs = np.asarray(runs).astype(np.uint64)
+        lumis = np.asarray(lumis).astype(np.uint64)
+        return (runs << np.uint64(32)) | lumis
+
+    @classmethod
+    def from_json(cls, path):
+        with open(path) as f:
+            certified = json.load(f)
+        ranges = [
+            (int(run), lumi_range[0], lumi_range[1])
+            for run, lumi_ranges in certified.items()
+            for lumi_range in lumi_ranges
+        ]
+        runs, first, last = np.array(sorted(ranges), dtype=np.uint64).reshape(-1, 3).T
+        return cls(cls.key(runs, first), cls.key(runs, last))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads the index saved next to the json by a previous job, or builds it from
+        the json and tries to save it there for the next ones.
+        """
+        index_path = os.path.splitext(path)[0] + ".npz"
+        if os.path.exists(index_path) and os.path.getmtime(
+            index_path
+        ) >= os.path.getmtime(path):
+            with np.load(index_path) as index:
+                return cls(index["starts"], index["ends"])
+
+        mask = cls.from_json(path)
+        try:
+            mask.save(index_path)
+        except OSError:
+            # e.g. read-only data directory on the worker node, the json is enough
+            pass
+        return mask
+
+    def save(self, index_path):
+        # write to a temporary file first, so parallel jobs never read a partial index
+        tmp_path = f"{index_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, starts=self.starts, ends=self.ends)
+        os.replace(tmp_path, index_path)
+
+    def __call__(self, runs, lumis):
+        keys = self.key(runs, lumis)
+        i = np.searchsorted(self.starts, keys, side="right") - 1
+        return (i >= 0) & (keys <= self.ends[np.maximum(i, 0)])
+
+
+def getLumiMask(era):
+    if era not in golden_jsons:
+        raise Exception("No era is defined. Please specify the year")
+
+    path = golden_jsons[era]
+    if path not in _lumi_masks:
+        _lumi_masks[path] = CompactLumiMask.load(path)
+
+    return _lumi_masks[path]
 
 
 def applyGoldenJSON(self, events):
-    if self.era == 2016:
-        LumiJSON = lumi_tools.LumiMask(
-            "data/GoldenJSON/Cert_271036-284044_13TeV_Legacy2016_Collisions16_JSON.txt"
-        )
-    elif self.era == 2017:
-        LumiJSON = lumi_tools.LumiMask(
-            "data/GoldenJSON/Cert_294927-306462_13TeV_UL2017_Collisions17_GoldenJSON.txt"
-        )
-    elif self.era == 2018:
-        LumiJSON = lumi_tools.LumiMask(
-            "data/GoldenJSON/Cert_314472-325175_13TeV_Legacy2018_Collisions18_JSON.txt"
-        )
-    else:
-        print("No era is defined. Please specify the year")
-
-    events = events[LumiJSON(events.run, events.luminosityBlock)]
+    LumiJSON = getLumiMask(self.era)
+
+    events = events[
+        LumiJSON(ak.to_numpy(events.run), ak.to_numpy(events.luminosityBlock))
+    ]
 
     return events
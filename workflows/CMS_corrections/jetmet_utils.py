@@ -1,11 +1,23 @@
+import os
+import pickle
+
 import awkward as ak
 import cachetools
+import cloudpickle
 import numpy as np
 from coffea.jetmet_tools import CorrectedJetsFactory, JECStack
 from coffea.lookup_tools import extractor
 
+# process-wide cache of the jet factories, keyed by (era, isMC, jecdir, jerdir, prefix)
+# so that the correction text files are parsed once per worker, not once per chunk
+_jet_factories = {}
+
 
-def apply_jecs(isMC, Sample, era, events, prefix=""):
+def get_jec_dirs(isMC, Sample, era):
+    """
+    Returns the names of the JEC and JER directories for the given era and sample.
+    """
+    jecdir, jerdir = None, None
 
     # Find the Collection we want to look at
     if isMC:
@@ -61,56 +73,101 @@ def apply_jecs(isMC, Sample, era, events, prefix=""):
         else:
             print("WARNING: Unable to find the correct JECs for Data!")
 
+    return jecdir, jerdir
+
+
+def make_evaluator(isMC, jecdir, jerdir, prefix="", cache_dir=None):
+    """
+    Parses the JEC/JER text files into a coffea evaluator.
+    If cache_dir is set, the evaluator is pickled there the first time it is built,
+    and read back from the pickle afterwards instead of parsing the text files,
+    as long as none of the text files is newer than the pickle.
+    """
+
     # Start working here
     jec_path = prefix + "data/jetmet/JEC/" + jecdir + "/"
     jer_path = prefix + "data/jetmet/JER/" + jerdir + "/"
 
     # Defined the weight sets we want to use
-    ext_ak4 = extractor()
     if isMC:
-        ext_ak4.add_weight_sets(
-            [  # change to correct files
-                "* * "
-                + jec_path
-                + jecdir
-                + "_L1FastJet_AK4PFchs.jec.txt",  # looks to be 0,
-                #'* * ' + jec_path + jecdir +"_L1RC_AK4PFchs.jec.txt", #needs area
-                #'* * ' + jec_path + jecdir +"_L2L3Residual_AK4PFchs.jec.txt",
-                #'* * ' + jec_path + jecdir +"_L2Residual_AK4PFchs.jec.txt",
-                "* * " + jec_path + jecdir + "_L2Relative_AK4PFchs.jec.txt",
-                "* * "
-                + jec_path
-                + jecdir
-                + "_L3Absolute_AK4PFchs.jec.txt",  # looks to be 1, no change
-                "* * " + jec_path + jecdir + "_Uncertainty_AK4PFchs.junc.txt",
-                "* * " + jer_path + jerdir + "_PtResolution_AK4PFchs.jr.txt",
-                "* * " + jer_path + jerdir + "_SF_AK4PFchs.jersf.txt",
-            ]
-        )
+        weight_sets = [  # change to correct files
+            "* * "
+            + jec_path
+            + jecdir
+            + "_L1FastJet_AK4PFchs.jec.txt",  # looks to be 0,
+            #'* * ' + jec_path + jecdir +"_L1RC_AK4PFchs.jec.txt", #needs area
+            #'* * ' + jec_path + jecdir +"_L2L3Residual_AK4PFchs.jec.txt",
+            #'* * ' + jec_path + jecdir +"_L2Residual_AK4PFchs.jec.txt",
+            "* * " + jec_path + jecdir + "_L2Relative_AK4PFchs.jec.txt",
+            "* * "
+            + jec_path
+            + jecdir
+            + "_L3Absolute_AK4PFchs.jec.txt",  # looks to be 1, no change
+            "* * " + jec_path + jecdir + "_Uncertainty_AK4PFchs.junc.txt",
+            "* * " + jer_path + jerdir + "_PtResolution_AK4PFchs.jr.txt",
+            "* * " + jer_path + jerdir + "_SF_AK4PFchs.jersf.txt",
+        ]
     else:
-        ext_ak4.add_weight_sets(
-            [  # change to correct files
-                "* * "
-                + jec_path
-                + jecdir
-                + "_L1FastJet_AK4PFchs.jec.txt",  # looks to be 0,
-                "* * " + jec_path + jecdir + "_L1RC_AK4PFchs.jec.txt",  # needs area
-                "* * " + jec_path + jecdir + "_L2L3Residual_AK4PFchs.jec.txt",
-                "* * " + jec_path + jecdir + "_L2Residual_AK4PFchs.jec.txt",
-                "* * " + jec_path + jecdir + "_L2Relative_AK4PFchs.jec.txt",
-                "* * "
-                + jec_path
-                + jecdir
-                + "_L3Absolute_AK4PFchs.jec.txt",  # looks to be 1, no change
-                #'* * ' + jec_path + jecdir +"_Uncertainty_AK4PFchs.junc.txt",
-                #'* * ' + jer_path + jerdir +"_PtResolution_AK4PFchs.jr.txt",
-                #'* * ' + jer_path + jerdir +"_SF_AK4PFchs.jersf.txt",
-            ]
+        weight_sets = [  # change to correct files
+            "* * "
+            + jec_path
+            + jecdir
+            + "_L1FastJet_AK4PFchs.jec.txt",  # looks to be 0,
+            "* * " + jec_path + jecdir + "_L1RC_AK4PFchs.jec.txt",  # needs area
+            "* * " + jec_path + jecdir + "_L2L3Residual_AK4PFchs.jec.txt",
+            "* * " + jec_path + jecdir + "_L2Residual_AK4PFchs.jec.txt",
+            "* * " + jec_path + jecdir + "_L2Relative_AK4PFchs.jec.txt",
+            "* * "
+            + jec_path
+            + jecdir
+            + "_L3Absolute_AK4PFchs.jec.txt",  # looks to be 1, no change
+            #'* * ' + jec_path + jecdir +"_Uncertainty_AK4PFchs.junc.txt",
+            #'* * ' + jer_path + jerdir +"_PtResolution_AK4PFchs.jr.txt",
+            #'* * ' + jer_path + jerdir +"_SF_AK4PFchs.jersf.txt",
+        ]
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(
+            cache_dir,
+            "{}_{}_{}.pkl".format(jecdir, jerdir, "MC" if isMC else "DATA"),
         )
+        # newest of the text files, the pickle is rebuilt if they were updated
+        mtime = max(os.path.getmtime(w.split()[-1]) for w in weight_sets)
+        if os.path.isfile(cache_file):
+            with open(cache_file, "rb") as f:
+                cached = pickle.load(f)
+            if isinstance(cached, dict) and cached.get("mtime", -1) >= mtime:
+                return cached["evaluator"]
 
+    ext_ak4 = extractor()
+    ext_ak4.add_weight_sets(weight_sets)
     ext_ak4.finalize()
     evaluator_ak4 = ext_ak4.make_evaluator()
 
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first, other workers may be reading the cache
+        tmp_file = cache_file + ".{}.tmp".format(os.getpid())
+        # cloudpickle, the evaluator holds lambdas that pickle cannot serialize
+        with open(tmp_file, "wb") as f:
+            cloudpickle.dump({"mtime": mtime, "evaluator": evaluator_ak4}, f)
+        os.replace(tmp_file, cache_file)
+
+    return evaluator_ak4
+
+
+def get_jet_factory(isMC, era, jecdir, jerdir, prefix="", cache_dir=None):
+    """
+    Returns the CorrectedJetsFactory for the given corrections, building it
+    only the first time it is requested in this process.
+    """
+    key = (era, isMC, jecdir, jerdir, prefix)
+    if key in _jet_factories:
+        return _jet_factories[key]
+
+    evaluator_ak4 = make_evaluator(isMC, jecdir, jerdir, prefix, cache_dir)
+
     if isMC:
         jec_stack_names_ak4 = [
             jecdir + "_L1FastJet_AK4PFchs",
@@ -139,16 +196,6 @@ def apply_jecs(isMC, Sample, era, events, prefix=""):
     jec_inputs_ak4 = {name: evaluator_ak4[name] for name in jec_stack_names_ak4}
     jec_stack_ak4 = JECStack(jec_inputs_ak4)
 
-    # Prepare the jets from the events
-    jets = events.Jet
-    jets["pt_raw"] = (1 - jets["rawFactor"]) * jets["pt"]
-    jets["mass_raw"] = (1 - jets["rawFactor"]) * jets["mass"]
-    if isMC:
-        jets["pt_gen"] = ak.values_astype(
-            ak.fill_none(jets.matched_gen.pt, 0), np.float32
-        )
-    jets["rho"] = ak.broadcast_arrays(events.fixedGridRhoFastjetAll, jets.pt)[0]
-
     # Create the map (for both MC and data)
     name_map = jec_stack_ak4.blank_name_map
     name_map["JetPt"] = "pt"
@@ -161,9 +208,61 @@ def apply_jecs(isMC, Sample, era, events, prefix=""):
     if isMC:
         name_map["ptGenJet"] = "pt_gen"
 
+    jet_factory = CorrectedJetsFactory(name_map, jec_stack_ak4)
+    _jet_factories[key] = jet_factory
+    return jet_factory
+
+
+def apply_jecs(isMC, Sample, era, events, prefix="", cache_dir=None):
+
+    jecdir, jerdir = get_jec_dirs(isMC, Sample, era)
+    jet_factory = get_jet_factory(isMC, era, jecdir, jerdir, prefix, cache_dir)
+
+    # Prepare the jets from the events
+    jets = events.Jet
+    jets["pt_raw"] = (1 - jets["rawFactor"]) * jets["pt"]
+    jets["mass_raw"] = (1 - jets["rawFactor"]) * jets["mass"]
+    if isMC:
+        jets["pt_gen"] = ak.values_astype(
+            ak.fill_none(jets.matched_gen.pt, 0), np.float32
+        )
+    jets["rho"] = ak.broadcast_arrays(events.fixedGridRhoFastjetAll, jets.pt)[0]
+
     # create and return the corrected jet collection
     jec_cache = cachetools.Cache(np.inf)
-    jet_factory = CorrectedJetsFactory(name_map, jec_stack_ak4)
     corrected_jets = jet_factory.build(jets, lazy_cache=jec_cache)
 
     return corrected_jets
+
+
+def ht_variations(jets, variations=None, min_pt=30, max_eta=2.4):
+    """
+    Scalar sum of the pT of the jets with pt > min_pt and |eta| < max_eta, for the
+    nominal jets and for the up and down variations of each source of corrected
+    jets (e.g. from apply_jecs), all summed at once.
+    variations: {name: field of jets}, e.g. {"JER": "JER", "JES": "JES_jes"}
+    Returns: {"": nominal, "_<name>_up": ..., "_<name>_down": ...} of numpy arrays.
+    """
+    if variations is None:
+        variations = {}
+
+    labels = [""]
+    pts = [jets.pt]
+    for name, field in variations.items():
+        labels += [f"_{name}_up", f"_{name}_down"]
+        pts += [jets[field].up.pt, jets[field].down.pt]
+
+    # the corrections change pt and mass only, so the eta cut is the same for all
+    counts = ak.to_numpy(ak.num(jets))
+    eta_cut = np.abs(ak.to_numpy(ak.flatten(jets.eta))) < max_eta
+    pt = np.stack([ak.to_numpy(ak.flatten(p)) for p in pts])
+    pt = np.where((pt > min_pt) & eta_cut, pt, 0)
+
+    # sum each (variation, event) in a single bincount
+    nevents = len(counts)
+    index = np.arange(len(pts))[:, None] * nevents + np.repeat(
+        np.arange(nevents), counts
+    )
+    ht = np.bincount(index.ravel(), weights=pt.ravel(), minlength=len(pts) * nevents)
+
+    return dict(zip(labels, ht.reshape(len(pts), nevents)))
@@ -1,15 +1,30 @@
+import zlib
+
 import awkward as ak
 import numpy as np
 
 
-def track_killing(self, tracks):
+def get_rng(key):
+    """
+    Returns a numpy random Generator seeded from a string key (e.g. the chunk's
+    partition key), so that the track killing is reproducible for each chunk.
+    """
+    return np.random.default_rng(zlib.crc32(key.encode()))
+
+
+def track_killing(self, tracks, rng=None):
     """
     Drop 2.7%, 2.2%, and 2.1% of the tracks randomly at reco-level
     for charged-particles with 1 < pT < 20 GeV in simulation for 2016, 2017, and
     2018, respectively when reclustering the constituents.
      For charged-particles with pT > 20 GeV, 1% of the tracks are dropped randomly
+    In each event, int(percent * n) tracks of each block are drawn (with replacement)
+    to be dropped. All the draws of the chunk are made at once on the flattened tracks.
     """
 
+    if rng is None:
+        rng = np.random.default_rng()
+
     if self.scouting:
         block1_percent = 0.05
         block2_percent = 0.01
@@ -18,29 +33,28 @@ def track_killing(self, tracks):
         block1_percent = year_percent[str(self.era)]
         block2_percent = 0.01
 
-    block0_indices = tracks.pt <= 1
-    block1_indices = (tracks.pt > 1) & (tracks.pt < 20)
-    block2_indices = tracks.pt >= 20
+    counts = ak.to_numpy(ak.num(tracks))
+    pt = ak.to_numpy(ak.flatten(tracks.pt))
+
+    # block of each track: 0 (pT <= 1, never dropped), 1 (1 < pT < 20), 2 (pT >= 20)
+    block = np.where(pt >= 20, 2, np.where(pt > 1, 1, 0))
 
-    new_indices = []
-    for i in range(len(tracks)):
-        event_indices = np.arange(len(tracks[i]))
-        event_bool = np.array([True] * len(tracks[i]))
+    # group the tracks by (event, block)
+    group = np.repeat(np.arange(len(counts)), counts) * 3 + block
+    order = np.argsort(group, kind="stable")
+    group_size = np.bincount(group, minlength=3 * len(counts))
+    group_start = np.cumsum(group_size) - group_size
 
-        block1_event_indices = event_indices[block1_indices[i]]
-        block1_event_indices_drop = np.random.choice(
-            block1_event_indices, int((block1_percent) * len(block1_event_indices))
-        )
-        event_bool[block1_event_indices_drop] = False
+    # number of tracks to drop in each group
+    percent = np.tile([0.0, block1_percent, block2_percent], len(counts))
+    n_drop = (percent * group_size).astype(np.int64)
 
-        block2_event_indices = event_indices[block2_indices[i]]
-        block2_event_indices_drop = np.random.choice(
-            block2_event_indices, int((block2_percent) * len(block2_event_indices))
-        )
-        event_bool[block2_event_indices_drop] = False
+    # draw the tracks to drop in each group
+    drop_group = np.repeat(np.arange(len(group_size)), n_drop)
+    drop_pos = group_start[drop_group] + rng.integers(0, group_size[drop_group])
 
-        new_indices.append(list(event_bool))
+    keep = np.ones(len(pt), dtype=bool)
+    keep[order[drop_pos]] = False
 
-    new_indices = ak.Array(new_indices)
-    tracks = tracks[new_indices]
+    tracks = tracks[ak.unflatten(keep, counts)]
     return tracks
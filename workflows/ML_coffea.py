@@ -190,15 +190,17 @@ class ML_cluster(processor.ProcessorABC):
         SUEP_tracks_b_CL = SUEP_cluster_tracks.boost_p4(boost_SUEP)
 
         # SUEP jet variables
-        eigs = SUEP_utils.sphericity(SUEP_tracks_b_CL, 1.0)  # Set r=1.0 for IRC safe
+        # Set r=1.0 for IRC safe
+        S1 = SUEP_utils.sphericity(SUEP_tracks_b_CL, 1.0, only_S1=True)
         out_vars["SUEP_nconst_CL"] = ak.num(SUEP_tracks_b_CL)
-        out_vars["SUEP_S1_CL"] = 1.5 * (eigs[:, 1] + eigs[:, 0])
+        out_vars["SUEP_S1_CL"] = S1
 
         tracks_b_CL = tracks_CL.boost_p4(boost_SUEP)
 
         # event variables
-        eigs = SUEP_utils.sphericity(tracks_b_CL, 1.0)  # Set r=1.0 for IRC safe
-        out_vars["event_S1_CL"] = 1.5 * (eigs[:, 1] + eigs[:, 0])
+        # Set r=1.0 for IRC safe
+        S1 = SUEP_utils.sphericity(tracks_b_CL, 1.0, only_S1=True)
+        out_vars["event_S1_CL"] = S1
 
         # some extra selections
         indices = (out_vars["SUEP_S1_CL"] > 0.3) & (out_vars["SUEP_nconst_CL"] > 40)
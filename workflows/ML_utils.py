@@ -2,7 +2,6 @@ import awkward as ak
 import numpy as np
 import onnxruntime as ort
 import vector
-from numba import jit
 
 vector.register_awkward()
 
@@ -13,6 +12,10 @@ from torch_geometric.nn.pool import avg_pool_x
 
 import workflows.SUEP_utils as SUEP_utils
 
+# GNN models and ONNX sessions, loaded once per process and reused for all the chunks
+_gnn_models = {}
+_ort_sessions = {}
+
 
 def SSDMethod(self, indices, events, out_label=""):
     #####################################################################################
@@ -25,37 +28,29 @@ def SSDMethod(self, indices, events, out_label=""):
 
     if self.do_inf:
 
-        pred_dict = {}
-        ort_infs = {}
-        options = ort.SessionOptions()
-        options.inter_op_num_threads = 1  # number of threads used to parallelize the execution of the graph (across nodes). Default is 0 to let onnxruntime choose.
-        for model in self.ssd_models:
-            ort_infs.update(
-                {
-                    model: ort.InferenceSession(
-                        f"data/onnx_models/resnet_{model}_{self.era}.onnx"
-                    )
-                }
+        ort_infs = {
+            model: get_ort_session(
+                f"data/onnx_models/resnet_{model}_{self.era}.onnx",
+                intra_op_num_threads=self.ort_intra_threads,
+                inter_op_num_threads=self.ort_inter_threads,
             )
+            for model in self.ssd_models
+        }
+        pred_dict = {
+            model: np.zeros(len(events), dtype=np.float32) for model in self.ssd_models
+        }
+
         # In order to avoid memory issues convert events to images and run inference in batches
-        # also exploits the numba-compiled convert_to_images function
-        for i in range(0, len(inf_cands), self.batch_size):
-            if i + self.batch_size > len(inf_cands):
-                self.batch_size = len(inf_cands) - i
-            batch = inf_cands[i : i + self.batch_size]
+        for i in range(0, len(events), self.batch_size):
+            batch = events[i : i + self.batch_size]
             imgs = convert_to_images(self, batch)
             for model in self.ssd_models:
-                batch_resnet_jets = run_inference_SSD(self, imgs, ort_infs[model])
-                if i == 0:
-                    resnet_jets = batch_resnet_jets
-                else:
-                    resnet_jets = np.concatenate((resnet_jets, batch_resnet_jets))
-                pred_dict.update(
-                    {model: resnet_jets[:, 1]}
-                )  # highest SUEP prediction per event
+                resnet_jets = run_inference_SSD(self, imgs, ort_infs[model])
+                # highest SUEP prediction per event
+                pred_dict[model][i : i + len(batch)] = resnet_jets[:, 1]
 
         for model in self.ssd_models:
-            self.out_vars.loc[indices, model + "_ssd" + out_label] = pred_dict[model]
+            self.out_vars.fill(model + "_ssd" + out_label, pred_dict[model], indices)
 
 
 def DGNNMethod(
@@ -77,34 +72,18 @@ def DGNNMethod(
 
     if self.do_inf:
 
-        import yaml
-
-        device = torch.device("cpu")
-
-        modelDir = "data/GNN/"
-
         # consistency check
         assert len(self.dgnn_model_names) == len(self.configs)
 
         for model_name, config in zip(self.dgnn_model_names, self.configs):
 
-            model_path = modelDir + model_name + ".pt"
-
-            # initialize model with original configurations and import the weights
-            config = yaml.safe_load(open(modelDir + config))
-            suep = SUEPNet(
-                out_dim=config["model_pref"]["out_dim"],
-                hidden_dim=config["model_pref"]["hidden_dim"],
-            ).to(device)
-            suep.load_state_dict(
-                torch.load(model_path, map_location=torch.device("cpu"))["model"]
-            )
-            suep = suep.float()
-            suep.eval()
+            suep = get_GNN_model(model_name, config)
 
             # run GNN inference on the SUEP tracks
             results = run_inference_GNN(self, suep, SUEP_tracks, SUEP_cand)
-            self.out_vars.loc[indices, "SUEP_" + model_name + "_GNN" + out_label] = results
+            self.out_vars.fill(
+                "SUEP_" + model_name + "_GNN" + out_label, results, indices
+            )
 
             # calculate other obserables to store
             boost_SUEP = ak.zip(
@@ -117,21 +96,20 @@ def DGNNMethod(
                 with_name="Momentum4D",
             )
             SUEP_tracks_b = SUEP_tracks.boost_p4(boost_SUEP)
-            eigs = SUEP_utils.sphericity(SUEP_tracks_b, 1.0)  # Set r=1.0 for IRC safe
-            self.out_vars.loc[indices, "SUEP_nconst_GNN" + out_label] = ak.num(
-                SUEP_tracks
-            )
-            self.out_vars.loc[indices, "SUEP_S1_GNN" + out_label] = 1.5 * (
-                eigs[:, 1] + eigs[:, 0]
+            # Set r=1.0 for IRC safe
+            S1 = SUEP_utils.sphericity(SUEP_tracks_b, 1.0, only_S1=True)
+            self.out_vars.fill(
+                "SUEP_nconst_GNN" + out_label, ak.num(SUEP_tracks), indices
             )
+            self.out_vars.fill("SUEP_S1_GNN" + out_label, S1, indices)
 
             if do_inverted:
 
                 # run GNN inference on the SUEP tracks
                 results = run_inference_GNN(self, suep, ISR_tracks, ISR_cand)
-                self.out_vars.loc[
-                    indices, "ISR_" + model_name + "_GNN" + out_label
-                ] = results
+                self.out_vars.fill(
+                    "ISR_" + model_name + "_GNN" + out_label, results, indices
+                )
 
                 # calculate other obserables to store
                 boost_ISR = ak.zip(
@@ -144,48 +122,58 @@ def DGNNMethod(
                     with_name="Momentum4D",
                 )
                 ISR_tracks_b = ISR_tracks.boost_p4(boost_ISR)
-                eigs = SUEP_utils.sphericity(
-                    ISR_tracks_b, 1.0
-                )  # Set r=1.0 for IRC safe
-                self.out_vars.loc[indices, "ISR_nconst_GNN" + out_label] = ak.num(
-                    ISR_tracks
-                )
-                self.out_vars.loc[indices, "ISR_S1_GNN" + out_label] = 1.5 * (
-                    eigs[:, 1] + eigs[:, 0]
+                # Set r=1.0 for IRC safe
+                S1 = SUEP_utils.sphericity(ISR_tracks_b, 1.0, only_S1=True)
+                self.out_vars.fill(
+                    "ISR_nconst_GNN" + out_label, ak.num(ISR_tracks), indices
                 )
+                self.out_vars.fill("ISR_S1_GNN" + out_label, S1, indices)
+
+
+def get_GNN_model(model_name, config, modelDir="data/GNN/"):
+    """
+    Returns the SUEPNet model_name, initialized with the configuration in config
+    and the weights in model_name.pt. Each model is only loaded once per process.
+    """
+
+    key = (modelDir, model_name, config)
+    if key not in _gnn_models:
+
+        import yaml
+
+        device = torch.device("cpu")
+        model_path = modelDir + model_name + ".pt"
+
+        # initialize model with original configurations and import the weights
+        with open(modelDir + config) as f:
+            config = yaml.safe_load(f)
+        suep = SUEPNet(
+            out_dim=config["model_pref"]["out_dim"],
+            hidden_dim=config["model_pref"]["hidden_dim"],
+        ).to(device)
+        suep.load_state_dict(torch.load(model_path, map_location=device)["model"])
+        suep = suep.float()
+        suep.eval()
+        _gnn_models[key] = suep
+
+    return _gnn_models[key]
 
 
 def run_inference_GNN(self, model, tracks, SUEP_cand):
 
-    results = np.array([])
+    results = np.zeros(len(tracks), dtype=np.float32)
+    sigmoid = torch.nn.Sigmoid()
     for i in range(0, len(tracks), self.batch_size):
 
         # define batch and convert objects in a coordinate frame
         batch = tracks[i : i + self.batch_size]
-        this_batch_size = len(batch)
         batch_SUEP_cand = SUEP_cand[i : i + self.batch_size]
-        batch = GNN_convertEvents(self, batch, batch_SUEP_cand)
 
-        sigmoid = torch.nn.Sigmoid()
-        with torch.no_grad():
+        # flattened batch in the DGNN format
+        # x_pf dims: (events times tracks, 4), x_pf_batch dims: (events times tracks)
+        x_pf, x_pf_batch = GNN_convertEvents(self, batch, batch_SUEP_cand)
 
-            # count how many tracks per event are nonzero: dimensions of (events, tracks)
-            Nlc = np.count_nonzero(batch[:, :, 0], axis=1)
-
-            # reshape the batch for correct DGNN format
-            x_pf = None  # dims: (events times tracks, 4)
-            x_pf_batch = None  # dim: (events times tracks)
-            for idx in range(this_batch_size):
-                # flatten the batch
-                if idx == 0:
-                    x_pf = batch[idx, : Nlc[idx], :]
-                else:
-                    x_pf = np.vstack((x_pf, batch[idx, : Nlc[idx], :]))
-                # event indices
-                if idx == 0:
-                    x_pf_batch = np.ones(Nlc[idx]) * idx
-                else:
-                    x_pf_batch = np.concatenate((x_pf_batch, np.ones(Nlc[idx]) * idx))
+        with torch.no_grad():
 
             # convert to torch
             x_pf = torch.from_numpy(x_pf).float()
@@ -197,7 +185,7 @@ def run_inference_GNN(self, model, tracks, SUEP_cand):
             # normalize the outputs
             nn1 = out[0][:, 0]
             nn1 = sigmoid(nn1)
-            results = np.concatenate((results, nn1.cpu().numpy()))
+            results[i : i + len(batch)] = nn1.cpu().numpy()
 
     return results
 
@@ -245,57 +233,113 @@ class SUEPNet(nn.Module):
         return out, batch
 
 
-@jit(forceobj=True)
-def convert_to_images(self, events):
+def convert_to_images(self, events, sparse=False):
+    """
+    Builds the normalized pT images, dimensions (events x 1 x eta_pix x phi_pix),
+    of a batch of events as float32. All tracks of the batch are scattered at once
+    on the flattened pixel indices; when tracks share a pixel the last one is kept,
+    as in the images used for the training. The mean and std of each image are
+    computed from its filled pixels only.
+    If sparse, returns instead (event, eta, phi) pixel indices, the normalized
+    values of the filled pixels, the normalized value of the empty pixels of each
+    image and the dense shape.
+    """
+
+    npix = self.eta_pix * self.phi_pix
+    shape = (len(events), 1, self.eta_pix, self.phi_pix)
 
     # Turn the PFcand info into indexes on the image map
-    idx_eta = ak.values_astype(
-        np.floor((events.eta - self.eta_span[0]) * self.eta_scale), "int64"
+    eta = ak.to_numpy(ak.flatten(events.eta))
+    phi = ak.to_numpy(ak.flatten(events.phi))
+    pt = ak.to_numpy(ak.flatten(events.pt)).astype(np.float32)
+    idx_eta = np.floor((eta - self.eta_span[0]) * self.eta_scale).astype(np.int64)
+    idx_phi = np.floor((phi - self.phi_span[0]) * self.phi_scale).astype(np.int64)
+    idx_eta[idx_eta == self.eta_pix] = self.eta_pix - 1
+    idx_phi[idx_phi == self.phi_pix] = self.phi_pix - 1
+    idx_event = np.repeat(np.arange(len(events)), ak.to_numpy(ak.num(events)))
+    flat_idx = (idx_event * self.eta_pix + idx_eta) * self.phi_pix + idx_phi
+
+    # value of each filled pixel, the last track written to it wins
+    pixels, last = np.unique(flat_idx[::-1], return_index=True)
+    values = pt[::-1][last]
+    pixel_event = pixels // npix
+
+    # normalize pt, from the filled pixels only (the others are 0)
+    s1 = np.bincount(pixel_event, weights=values, minlength=len(events))
+    s2 = np.bincount(
+        pixel_event, weights=values.astype(np.float64) ** 2, minlength=len(events)
     )
-    idx_phi = ak.values_astype(
-        np.floor((events.phi - self.phi_span[0]) * self.phi_scale), "int64"
-    )
-    idx_eta = ak.where(idx_eta == self.eta_pix, self.eta_pix - 1, idx_eta)
-    idx_phi = ak.where(idx_phi == self.phi_pix, self.phi_pix - 1, idx_phi)
-    pt = events.pt
+    m = s1 / npix
+    std = np.sqrt(np.maximum(s2 / npix - m**2, 0))
+    scale = np.where(std != 0, std, 1)
+    offset = np.where(std != 0, m, 0)
+    values = ((values - offset[pixel_event]) / scale[pixel_event]).astype(np.float32)
+    background = (-offset / scale).astype(np.float32)
+
+    if sparse:
+        coords = np.stack(
+            np.unravel_index(pixels, (len(events), self.eta_pix, self.phi_pix))
+        )
+        return coords, values, background, shape
 
-    to_infer = np.zeros((len(events), 1, self.eta_pix, self.phi_pix))
-    for event_i in range(len(events)):
+    to_infer = np.empty(shape, dtype=np.float32)
+    to_infer[:] = background[:, None, None, None]
+    to_infer.reshape(-1)[pixels] = values
 
-        # form image
-        to_infer[event_i, 0, idx_eta[event_i], idx_phi[event_i]] = pt[event_i]
+    return to_infer
 
-        # normalize pt
-        m = np.mean(to_infer[event_i, 0, :, :])
-        s = np.std(to_infer[event_i, 0, :, :])
-        if s != 0:
-            to_infer[event_i, 0, :, :] = (to_infer[event_i, 0, :, :] - m) / s
 
-    return to_infer
+def get_ort_session(model_path, intra_op_num_threads=0, inter_op_num_threads=1):
+    """
+    Returns the ONNX Runtime InferenceSession of model_path, created once per process
+    for each thread configuration. 0 threads lets onnxruntime choose.
+    """
+
+    key = (model_path, intra_op_num_threads, inter_op_num_threads)
+    if key not in _ort_sessions:
+        options = ort.SessionOptions()
+        # number of threads used to parallelize the execution within nodes
+        options.intra_op_num_threads = intra_op_num_threads
+        # number of threads used to parallelize the execution of the graph (across nodes)
+        options.inter_op_num_threads = inter_op_num_threads
+        _ort_sessions[key] = ort.InferenceSession(model_path, sess_options=options)
+
+    return _ort_sessions[key]
 
 
 def run_inference_SSD(self, imgs, ort_sess):
 
     # Running the inference in batch mode
-    input_name = ort_sess.get_inputs()[0].name
-    cl_outputs = np.array([])
-
-    for i, img in enumerate(imgs):
+    ort_input = ort_sess.get_inputs()[0]
+    imgs = np.asarray(imgs, dtype=np.float32)
+
+    # models exported with a fixed batch dimension are run in batches of that size
+    step = ort_input.shape[0] if isinstance(ort_input.shape[0], int) else len(imgs)
+    step = max(step, 1)
+
+    cl_outputs = None
+    for i in range(0, len(imgs), step):
+        batch = imgs[i : i + step]
+        n = len(batch)
+        if n < step:
+            # the last batch is zero-padded to the fixed batch size
+            batch = np.concatenate(
+                [batch, np.zeros((step - n,) + batch.shape[1:], np.float32)]
+            )
         # SSD: grab classification outputs (0 - loc, 1 - classifation, 2 - regression)
         # resnet: only classification as output
-        cl_output = ort_sess.run(None, {input_name: np.array([img.astype(np.float32)])})
-        cl_output_softmax = softmax(cl_output)[0]
-        if i == 0:
-            cl_outputs = cl_output_softmax
-        else:
-            cl_outputs = np.concatenate((cl_outputs, cl_output_softmax))
+        cl_output = ort_sess.run(None, {ort_input.name: batch})[0][:n]
+        if cl_outputs is None:
+            cl_outputs = np.empty((len(imgs),) + cl_output.shape[1:], np.float32)
+        cl_outputs[i : i + n] = softmax(cl_output)
 
     return cl_outputs
 
 
 def softmax(data):
-    # some numpy magic
-    return np.exp(data) / (np.exp(data).sum(axis=-1)[:, :, None])
+    # subtract the max for numerical stability
+    exp = np.exp(data - np.max(data, axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
 
 
 def GNN_convertEvents(self, events, SUEP_cand, max_objects=1000):
@@ -322,6 +366,11 @@ def GNN_convertEvents(self, events, SUEP_cand, max_objects=1000):
     else:
         raise Exception()
 
-    new_events = SUEP_utils.convert_coords(self.coords, events, max_objects)
+    # keep at most max_objects tracks per event and flatten them,
+    # x_pf_batch is the index of the event of each track in the batch
+    events = events[:, :max_objects]
+    x_pf = SUEP_utils.convert_coords_flat(self.coords, events)
+    counts = ak.to_numpy(ak.num(events))
+    x_pf_batch = np.repeat(np.arange(len(counts)), counts)
 
-    return new_events
+    return x_pf, x_pf_batch
@@ -4,16 +4,17 @@ Coffea producer for SUEP analysis. Uses fastjet package to recluster large jets:
 https://github.com/scikit-hep/fastjet
 Chad Freer and Luca Lavezzo, 2021
 """
-from typing import Optional
+from typing import List, Optional
 
 import awkward as ak
 import numpy as np
-import pandas as pd
 import vector
 from coffea import processor
 
 # IO utils
+import workflows.branch_audit as branch_audit
 import workflows.pandas_utils as pandas_utils
+import workflows.stage_profiler as stage_profiler
 
 # Importing SUEP specific functions
 import workflows.SUEP_utils as SUEP_utils
@@ -21,10 +22,10 @@ import workflows.ZH_utils as ZH_utils
 
 # Importing CMS corrections
 from workflows.CMS_corrections.golden_jsons_utils import applyGoldenJSON
-from workflows.CMS_corrections.jetmet_utils import apply_jecs
+from workflows.CMS_corrections.jetmet_utils import apply_jecs, ht_variations
 from workflows.CMS_corrections.PartonShower_utils import GetPSWeights
 from workflows.CMS_corrections.Prefire_utils import GetPrefireWeights
-from workflows.CMS_corrections.track_killing_utils import track_killing
+from workflows.CMS_corrections.track_killing_utils import get_rng, track_killing
 from workflows.CMS_corrections.HEM_utils import jetHEMFilter
 # Set vector behavior
 vector.register_awkward()
@@ -45,6 +46,9 @@ class SUEP_cluster(processor.ProcessorABC):
         output_location: Optional[str],
         accum: Optional[bool] = None,
         trigger: Optional[str] = None,
+        jec_cache_dir: Optional[str] = None,
+        preload_branches: Optional[List[str]] = None,
+        profile: bool = False,
     ) -> None:
         self._flag = flag
         self.output_location = output_location
@@ -63,7 +67,14 @@ class SUEP_cluster(processor.ProcessorABC):
         self.doOF = False
         self.accum = accum
         self.trigger = trigger
-        self.out_vars = pd.DataFrame()
+        self.jec_cache_dir = jec_cache_dir
+        self.preload_branches = preload_branches
+        self.profile = profile
+        if profile and accum and "dask" in accum:
+            # with dask, process returns only the DataFrame of the chunk
+            raise Exception("The stage profile is not supported with dask.")
+        self.profiler = stage_profiler.StageProfiler(False)
+        self.out_vars = pandas_utils.OutputBuilder()
 
         if self.do_inf:
 
@@ -81,6 +92,8 @@ class SUEP_cluster(processor.ProcessorABC):
 
             # SSD settings
             self.ssd_models = []  # Add to this list. There will be an output for each
+            self.ort_intra_threads = 0  # 0 lets onnxruntime choose
+            self.ort_inter_threads = 1
             self.eta_pix = 280
             self.phi_pix = 360
             self.eta_span = (-2.5, 2.5)
@@ -224,30 +237,10 @@ class SUEP_cluster(processor.ProcessorABC):
         tracks = ak.packed(Cleaned_cands)
         return tracks, Cleaned_cands
 
-    def getLooseLeptons(self, events):
-        
-        looseMuons = ak.zip(
-            {
-                "pt": events.Muon.pt,
-                "eta": events.Muon.eta,
-                "phi": events.Muon.phi,
-                "mass": events.Muon.mass,
-                "charge": events.Muon.pdgId / (-13),
-            },
-            with_name="Momentum4D",
-        )
-
-        looseElectrons = ak.zip(
-            {
-                "pt": events.Electron.pt,
-                "eta": events.Electron.eta,
-                "phi": events.Electron.phi,
-                "mass": events.Electron.mass,
-                "charge": events.Electron.pdgId / (-11),
-            },
-            with_name="Momentum4D",
-        )
-        
+    def getLooseLeptons(self, events, electrons, muons):
+        """
+        Loose leptons, from the electrons and muons of ZH_utils.getLeptons.
+        """
         cutLooseMuons = (
             (events.Muon.looseId)
             & (events.Muon.pt >= 1)
@@ -266,8 +259,8 @@ class SUEP_cluster(processor.ProcessorABC):
         
         ### Apply the cuts
         # Object selection. selMuons contain only the events that are filtered by cutMuons criteria.
-        looseMuons = looseMuons[cutLooseMuons]
-        looseElectrons = looseElectrons[cutLooseElectrons]
+        looseMuons = muons[cutLooseMuons]
+        looseElectrons = electrons[cutLooseElectrons]
 
         return looseElectrons, looseMuons
     
@@ -279,51 +272,37 @@ class SUEP_cluster(processor.ProcessorABC):
         # select out ak4jets
         ak4jets = self.jet_awkward(events.Jet)
 
-        # work on JECs and systematics
-        prefix = ""
-        if self.accum:
-            if "dask" in self.accum:
-                prefix = "dask-worker-space/"
-        jets_c = apply_jecs(
-            isMC=self.isMC,
-            Sample=self.sample,
-            era=self.era,
-            events=events,
-            prefix=prefix,
-        )
-        jets_jec = self.jet_awkward(jets_c)
-        if self.isMC:
-            jets_jec_JERUp = self.jet_awkward(jets_c["JER"].up)
-            jets_jec_JERDown = self.jet_awkward(jets_c["JER"].down)
-            jets_jec_JESUp = self.jet_awkward(jets_c["JES_jes"].up)
-            jets_jec_JESDown = self.jet_awkward(jets_c["JES_jes"].down)
-        # For data set these all to nominal so we can plot without switching all of the names
-        else:
-            jets_jec_JERUp = jets_jec
-            jets_jec_JERDown = jets_jec
-            jets_jec_JESUp = jets_jec
-            jets_jec_JESDown = jets_jec
-
         # save per event variables to a dataframe
-        self.out_vars["ntracks" + out_label] = ak.num(tracks).to_list()
-        self.out_vars["ngood_fastjets" + out_label] = ak.num(
-            ak_inclusive_jets
-        ).to_list()
+        self.out_vars["ntracks" + out_label] = ak.num(tracks)
+        self.out_vars["ngood_fastjets" + out_label] = ak.num(ak_inclusive_jets)
         if out_label == "":
-            self.out_vars["ht" + out_label] = ak.sum(ak4jets.pt, axis=-1).to_list()
-            self.out_vars["ht_JEC" + out_label] = ak.sum(jets_jec.pt, axis=-1).to_list()
-            self.out_vars["ht_JEC" + out_label + "_JER_up"] = ak.sum(
-                jets_jec_JERUp.pt, axis=-1
-            ).to_list()
-            self.out_vars["ht_JEC" + out_label + "_JER_down"] = ak.sum(
-                jets_jec_JERDown.pt, axis=-1
-            ).to_list()
-            self.out_vars["ht_JEC" + out_label + "_JES_up"] = ak.sum(
-                jets_jec_JESUp.pt, axis=-1
-            ).to_list()
-            self.out_vars["ht_JEC" + out_label + "_JES_down"] = ak.sum(
-                jets_jec_JESDown.pt, axis=-1
-            ).to_list()
+            self.out_vars["ht" + out_label] = ak.sum(ak4jets.pt, axis=-1)
+
+            # work on JECs and systematics
+            prefix = ""
+            if self.accum:
+                if "dask" in self.accum:
+                    prefix = "dask-worker-space/"
+            with self.profiler.stage("jecs", len(events)):
+                jets_c = apply_jecs(
+                    isMC=self.isMC,
+                    Sample=self.sample,
+                    era=self.era,
+                    events=events,
+                    prefix=prefix,
+                    cache_dir=self.jec_cache_dir,
+                )
+                # HT of the nominal and varied corrected jets, summed together
+                jec_variations = {}
+                if self.isMC:
+                    jec_variations = {"JER": "JER", "JES": "JES_jes"}
+                ht_jec = ht_variations(jets_c, jec_variations)
+            self.out_vars["ht_JEC" + out_label] = ht_jec[""]
+            # For data set these all to nominal so we can plot without switching all of the names
+            for variation in ["_JER_up", "_JER_down", "_JES_up", "_JES_down"]:
+                self.out_vars["ht_JEC" + out_label + variation] = ht_jec.get(
+                    variation, ht_jec[""]
+                )
             self.out_vars['n_sel_electrons'] = ak.to_numpy(ak.num(electrons))
             self.out_vars['n_sel_muons'] = ak.to_numpy(ak.num(muons))
             self.out_vars['n_sel_leps'] = ak.to_numpy(ak.num(electrons)) + ak.to_numpy(ak.num(muons))
@@ -336,7 +315,7 @@ class SUEP_cluster(processor.ProcessorABC):
                 self.out_vars["HLT_PFHT900" + out_label] = events.HLT.PFHT900
             elif self.scouting == 0:
                 self.out_vars["HLT_PFHT1050" + out_label] = events.HLT.PFHT1050
-            self.out_vars["ngood_ak4jets" + out_label] = ak.num(ak4jets).to_list()
+            self.out_vars["ngood_ak4jets" + out_label] = ak.num(ak4jets)
             if self.scouting == 1:
                 self.out_vars["PV_npvs" + out_label] = ak.num(events.Vertex.x)
             else:
@@ -350,25 +329,16 @@ class SUEP_cluster(processor.ProcessorABC):
                 self.out_vars["PV_npvsGood" + out_label] = events.PV.npvsGood
 
         # get gen SUEP kinematics
-        SUEP_genMass = len(events) * [0]
-        SUEP_genPt = len(events) * [0]
-        SUEP_genEta = len(events) * [0]
-        SUEP_genPhi = len(events) * [0]
-
+        # we need to grab the last SUEP in the chain for each event
         if self.isMC and not self.scouting:
-            genParts = self.getGenTracks(events)
-            genSUEP = genParts[(abs(genParts.pdgID) == 25)]
-
-            # we need to grab the last SUEP in the chain for each event
-            SUEP_genMass = [g[-1].mass if len(g) > 0 else 0 for g in genSUEP]
-            SUEP_genPt = [g[-1].pt if len(g) > 0 else 0 for g in genSUEP]
-            SUEP_genPhi = [g[-1].phi if len(g) > 0 else 0 for g in genSUEP]
-            SUEP_genEta = [g[-1].eta if len(g) > 0 else 0 for g in genSUEP]
+            genSUEP = SUEP_utils.getGenSUEP(events)
+        else:
+            genSUEP = {var: 0 for var in ["mass", "pt", "eta", "phi"]}
 
-        self.out_vars["SUEP_genMass" + out_label] = SUEP_genMass
-        self.out_vars["SUEP_genPt" + out_label] = SUEP_genPt
-        self.out_vars["SUEP_genEta" + out_label] = SUEP_genEta
-        self.out_vars["SUEP_genPhi" + out_label] = SUEP_genPhi
+        self.out_vars["SUEP_genMass" + out_label] = genSUEP["mass"]
+        self.out_vars["SUEP_genPt" + out_label] = genSUEP["pt"]
+        self.out_vars["SUEP_genEta" + out_label] = genSUEP["eta"]
+        self.out_vars["SUEP_genPhi" + out_label] = genSUEP["phi"]
 
     def initializeColumns(self, label=""):
         # need to add these to dataframe when no events pass to make the merging work
@@ -409,25 +379,42 @@ class SUEP_cluster(processor.ProcessorABC):
         for iCol in range(len(self.columns)):
             self.columns[iCol] = self.columns[iCol] + label
 
-    def analysis(self, events, do_syst=False, col_label=""):
-        #####################################################################################
-        # ---- Trigger event selection
-        # Cut based on ak4 jets to replicate the trigger
-        #####################################################################################
+    def preselection(self, events):
+        """
+        Event level selections, cheapest first: golden json, trigger and MET filters
+        on flat branches, then the lepton veto on the remaining events.
+        Returns the events, and their electrons and muons (from ZH_utils.getLeptons)
+        for the loose lepton counting.
+        """
 
         # golden jsons for offline data
         if not self.isMC and self.scouting != 1:
             events = applyGoldenJSON(self, events)
-        events, _, _ = ZH_utils.selectByLeptons(self, events, lepveto=True)
         events = self.eventSelection(events)
         events = self.selectByFilters(events)
 
+        # lepton veto, the leptons are built once and shared with getLooseLeptons
+        electrons, muons = ZH_utils.getLeptons(events)
+        selElectrons, selMuons = ZH_utils.selectLeptons(events, electrons, muons)
+        cutAnyLeps = ZH_utils.leptonVeto(selElectrons, selMuons)
+
+        return events[~cutAnyLeps], electrons[~cutAnyLeps], muons[~cutAnyLeps]
+
+    def analysis(self, events, electrons, muons, do_syst=False, col_label=""):
+        #####################################################################################
+        # ---- Trigger event selection
+        # Cut based on ak4 jets to replicate the trigger
+        # events, electrons, muons: as returned by preselection
+        #####################################################################################
+
         # output empty dataframe if no events pass trigger
         if len(events) == 0:
             print("No events passed trigger. Saving empty outputs.")
-            if self.accum == "pandas_merger":
-                self.out_vars = pd.DataFrame(["empty"], columns=["empty"])
+            if self.accum in ["pandas_merger", "parquet_merger"]:
+                self.out_vars.reset(1)
+                self.out_vars["empty"] = ["empty"]
             elif self.accum:
+                self.out_vars.allocate(0)
                 self.initializeColumns(col_label)
                 for c in self.columns:
                     self.out_vars[c] = np.nan
@@ -438,34 +425,39 @@ class SUEP_cluster(processor.ProcessorABC):
         # Prepare the clean PFCand matched to tracks collection
         #####################################################################################
 
-        if self.scouting == 1:
-            tracks, Cleaned_cands = self.getScoutingTracks(events)
-        else:
-            tracks, Cleaned_cands = self.getTracks(events)
+        with self.profiler.stage("tracks" + col_label, len(events)):
+            if self.scouting == 1:
+                tracks, Cleaned_cands = self.getScoutingTracks(events)
+            else:
+                tracks, Cleaned_cands = self.getTracks(events)
 
-        looseElectrons, looseMuons = self.getLooseLeptons(events)
-        
-        if self.isMC and do_syst:
-            tracks = track_killing(self, tracks)
-            Cleaned_cands = track_killing(self, Cleaned_cands)
+            looseElectrons, looseMuons = self.getLooseLeptons(events, electrons, muons)
+
+            if self.isMC and do_syst:
+                # seed from the chunk, so the systematic is reproducible
+                rng = get_rng(events.behavior["__events_factory__"]._partition_key)
+                tracks = track_killing(self, tracks, rng)
+                Cleaned_cands = track_killing(self, Cleaned_cands, rng)
 
         #####################################################################################
         # ---- FastJet reclustering
         # The jet clustering part
         #####################################################################################
 
-        ak_inclusive_jets, ak_inclusive_cluster = SUEP_utils.FastJetReclustering(
-            tracks, r=1.5, minPt=150
-        )
+        with self.profiler.stage("fastjet" + col_label, len(tracks)):
+            ak_inclusive_jets, ak_inclusive_cluster = SUEP_utils.FastJetReclustering(
+                tracks, r=1.5, minPt=150
+            )
 
         #####################################################################################
         # ---- Event level information
         #####################################################################################
 
-        self.storeEventVars(
-            events, tracks, ak_inclusive_jets, ak_inclusive_cluster, looseElectrons, looseMuons, 
-            out_label=col_label
-        )
+        with self.profiler.stage("event_vars" + col_label, len(events)):
+            self.storeEventVars(
+                events, tracks, ak_inclusive_jets, ak_inclusive_cluster, looseElectrons, looseMuons, 
+                out_label=col_label
+            )
 
         # indices of events in tracks, used to keep track which events pass selections
         indices = np.arange(0, len(tracks))
@@ -502,75 +494,120 @@ class SUEP_cluster(processor.ProcessorABC):
         )
         SUEP_cand, ISR_cand, SUEP_cluster_tracks, ISR_cluster_tracks = topTwoJets
 
-        SUEP_utils.ClusterMethod(
-            self,
-            indices,
-            tracks,
-            SUEP_cand,
-            ISR_cand,
-            SUEP_cluster_tracks,
-            ISR_cluster_tracks,
-            do_inverted=True,
-            out_label=col_label,
-        )
-
-        if self.do_inf:
-            import workflows.ML_utils as ML_utils
-
-            ML_utils.DGNNMethod(
+        with self.profiler.stage("cluster_method" + col_label, len(indices)):
+            SUEP_utils.ClusterMethod(
                 self,
                 indices,
-                SUEP_tracks=SUEP_cluster_tracks,
-                SUEP_cand=SUEP_cand,
-                ISR_tracks=ISR_cluster_tracks,
-                ISR_cand=ISR_cand,
-                out_label=col_label,
+                tracks,
+                SUEP_cand,
+                ISR_cand,
+                SUEP_cluster_tracks,
+                ISR_cluster_tracks,
                 do_inverted=True,
+                out_label=col_label,
             )
 
+        if self.do_inf:
+            import workflows.ML_utils as ML_utils
+
+            with self.profiler.stage("gnn" + col_label, len(indices)):
+                ML_utils.DGNNMethod(
+                    self,
+                    indices,
+                    SUEP_tracks=SUEP_cluster_tracks,
+                    SUEP_cand=SUEP_cand,
+                    ISR_tracks=ISR_cluster_tracks,
+                    ISR_cand=ISR_cand,
+                    out_label=col_label,
+                    do_inverted=True,
+                )
+
+            if self.ssd_models:
+                with self.profiler.stage("ssd" + col_label, len(indices)):
+                    ML_utils.SSDMethod(self, indices, tracks, out_label=col_label)
+
     def process(self, events):
         output = self.accumulator.identity()
         dataset = events.metadata["dataset"]
 
+        # time and memory of each stage of the chunk, if enabled (see stage_profiler.py)
+        self.profiler = stage_profiler.StageProfiler(self.profile)
+        if self.profile:
+            output["profile"] = self.profiler.accumulator
+
+        # read all the branches used by the analysis at once (see branch_audit.py)
+        if self.preload_branches:
+            with self.profiler.stage("preload", len(events)):
+                events = branch_audit.preload_events(events, self.preload_branches)
+
+        # per event outputs of this chunk, converted to a DataFrame at the end
+        self.out_vars = pandas_utils.OutputBuilder()
+
         # gen weights
         if self.isMC and self.scouting == 1:
             self.gensumweight = ak.num(events.PFcand.pt, axis=0)
         elif self.isMC:
             self.gensumweight = ak.sum(events.genWeight)
 
+        # event selections, shared by the analyses with and without systematics
+        with self.profiler.stage("preselection", len(events)):
+            events, electrons, muons = self.preselection(events)
+
         # run the analysis with the track systematics applied
         if self.isMC and self.do_syst:
-            self.analysis(events, do_syst=True, col_label="_track_down")
+            self.analysis(
+                events, electrons, muons, do_syst=True, col_label="_track_down"
+            )
 
         # run the analysis
-        self.analysis(events)
+        self.analysis(events, electrons, muons)
 
         # output result to dask dataframe accumulator
-        if self.accum:
-            if "dask" in self.accum:
-                return self.out_vars
-
-            # output result to iterative/futures accumulator
-            if "iterative" in self.accum or "futures" in self.accum:
-                # Convert output to the desired format when the accumulator is used
-                for c in self.out_vars.columns:
-                    output[c] = self.out_vars[c].to_list()
-                output = {dataset: self.out_vars}
-                return output
-
-            if "pandas_merger" == self.accum:
-
-                # save the out_vars object as a Pandas DataFrame
-                pandas_utils.save_dfs(
-                    self,
-                    [self.out_vars],
-                    ["vars"],
-                    events.behavior["__events_factory__"]._partition_key.replace(
-                        "/", "_"
+        with self.profiler.stage("output", len(events)):
+            if self.accum:
+                out_vars = self.out_vars.to_dataframe()
+
+                if "dask" in self.accum:
+                    return out_vars
+
+                # output result to iterative/futures accumulator
+                if "iterative" in self.accum or "futures" in self.accum:
+                    # Convert output to the desired format when the accumulator is used
+                    for c in out_vars.columns:
+                        output[c] = out_vars[c].to_list()
+                    output = {dataset: out_vars}
+                    if self.profile:
+                        output["profile"] = self.profiler.accumulator
+                    return output
+
+                if "pandas_merger" == self.accum:
+
+                    # save the out_vars object as a Pandas DataFrame
+                    pandas_utils.save_dfs(
+                        self,
+                        [out_vars],
+                        ["vars"],
+                        events.behavior["__events_factory__"]._partition_key.replace(
+                            "/", "_"
+                        )
+                        + ".hdf5",
                     )
-                    + ".hdf5",
-                )
-                return output
+                    return output
+
+                if "parquet_merger" == self.accum:
+
+                    # save the out_vars object as a Parquet file
+                    pandas_utils.save_parquet(
+                        self,
+                        out_vars,
+                        events.behavior["__events_factory__"]._partition_key.replace(
+                            "/", "_"
+                        )
+                        + ".parquet",
+                    )
+                    return output
 
     def postprocess(self, accumulator):
+        if self.profile and "profile" in accumulator:
+            print(stage_profiler.summary(accumulator["profile"]))
         return accumulator
@@ -42,34 +42,36 @@ def ClusterMethod(
     )  ### boost the SUEP tracks to their restframe
 
     # SUEP jet variables
-    eigs = sphericity(SUEP_tracks_b, 1.0)  # Set r=1.0 for IRC safe
-    self.out_vars.loc[indices, "SUEP_nconst_CL" + out_label] = ak.num(SUEP_tracks_b)
-    self.out_vars.loc[indices, "SUEP_pt_avg_b_CL" + out_label] = ak.mean(
-        SUEP_tracks_b.pt, axis=-1
-    )
-    self.out_vars.loc[indices, "SUEP_S1_CL" + out_label] = 1.5 * (
-        eigs[:, 1] + eigs[:, 0]
+    S1 = sphericity(SUEP_tracks_b, 1.0, only_S1=True)  # Set r=1.0 for IRC safe
+    self.out_vars.fill("SUEP_nconst_CL" + out_label, ak.num(SUEP_tracks_b), indices)
+    self.out_vars.fill(
+        "SUEP_pt_avg_b_CL" + out_label, ak.mean(SUEP_tracks_b.pt, axis=-1), indices
     )
+    self.out_vars.fill("SUEP_S1_CL" + out_label, S1, indices)
 
     # unboost for these
     SUEP_tracks = SUEP_tracks_b.boost_p4(SUEP_cand)
-    self.out_vars.loc[indices, "SUEP_pt_avg_CL" + out_label] = ak.mean(
-        SUEP_tracks.pt, axis=-1
+    self.out_vars.fill(
+        "SUEP_pt_avg_CL" + out_label, ak.mean(SUEP_tracks.pt, axis=-1), indices
     )
     deltaR = SUEP_tracks.deltaR(SUEP_cand)
     # self.out_vars.loc[indices, "SUEP_rho0_CL"+out_label] = rho(0, SUEP_cand, SUEP_tracks, deltaR)
     # self.out_vars.loc[indices, "SUEP_rho1_CL"+out_label] = rho(1, SUEP_cand, SUEP_tracks, deltaR)
 
-    self.out_vars.loc[indices, "SUEP_pt_CL" + out_label] = SUEP_cand.pt
-    self.out_vars.loc[indices, "SUEP_eta_CL" + out_label] = SUEP_cand.eta
-    self.out_vars.loc[indices, "SUEP_phi_CL" + out_label] = SUEP_cand.phi
-    self.out_vars.loc[indices, "SUEP_mass_CL" + out_label] = SUEP_cand.mass
+    self.out_vars.fill("SUEP_pt_CL" + out_label, SUEP_cand.pt, indices)
+    self.out_vars.fill("SUEP_eta_CL" + out_label, SUEP_cand.eta, indices)
+    self.out_vars.fill("SUEP_phi_CL" + out_label, SUEP_cand.phi, indices)
+    self.out_vars.fill("SUEP_mass_CL" + out_label, SUEP_cand.mass, indices)
 
-    self.out_vars.loc[indices, "SUEP_delta_mass_genMass_CL" + out_label] = (
-        SUEP_cand.mass - self.out_vars["SUEP_genMass" + out_label][indices]
+    self.out_vars.fill(
+        "SUEP_delta_mass_genMass_CL" + out_label,
+        SUEP_cand.mass - self.out_vars["SUEP_genMass" + out_label][indices],
+        indices,
     )
-    self.out_vars.loc[indices, "SUEP_delta_pt_genPt_CL" + out_label] = (
-        SUEP_cand.pt - self.out_vars["SUEP_genPt" + out_label][indices]
+    self.out_vars.fill(
+        "SUEP_delta_pt_genPt_CL" + out_label,
+        SUEP_cand.pt - self.out_vars["SUEP_genPt" + out_label][indices],
+        indices,
     )
 
     # Calculate orientation difference between candidate and actual SUEP
@@ -106,28 +108,26 @@ def ClusterMethod(
         assert all(ak.num(ISR_tracks_b) > 1)
 
         # ISR jet variables
-        eigs = sphericity(ISR_tracks_b, 1.0)  # Set r=1.0 for IRC safe
-        self.out_vars.loc[indices, "ISR_nconst_CL" + out_label] = ak.num(ISR_tracks_b)
-        self.out_vars.loc[indices, "ISR_pt_avg_b_CL" + out_label] = ak.mean(
-            ISR_tracks_b.pt, axis=-1
-        )
-        self.out_vars.loc[indices, "ISR_S1_CL" + out_label] = 1.5 * (
-            eigs[:, 1] + eigs[:, 0]
+        S1 = sphericity(ISR_tracks_b, 1.0, only_S1=True)  # Set r=1.0 for IRC safe
+        self.out_vars.fill("ISR_nconst_CL" + out_label, ak.num(ISR_tracks_b), indices)
+        self.out_vars.fill(
+            "ISR_pt_avg_b_CL" + out_label, ak.mean(ISR_tracks_b.pt, axis=-1), indices
         )
+        self.out_vars.fill("ISR_S1_CL" + out_label, S1, indices)
 
         # unboost for these
         ISR_tracks = ISR_tracks_b.boost_p4(ISR_cand)
-        self.out_vars.loc[indices, "ISR_pt_avg_CL" + out_label] = ak.mean(
-            ISR_tracks.pt, axis=-1
+        self.out_vars.fill(
+            "ISR_pt_avg_CL" + out_label, ak.mean(ISR_tracks.pt, axis=-1), indices
         )
         deltaR = ISR_tracks.deltaR(ISR_cand)
         # self.out_vars.loc[indices, "ISR_rho0_CL"+out_label] = rho(0, ISR_cand, ISR_tracks, deltaR)
         # self.out_vars.loc[indices, "ISR_rho1_CL"+out_label] = rho(1, ISR_cand, ISR_tracks, deltaR)
 
-        self.out_vars.loc[indices, "ISR_pt_CL" + out_label] = ISR_cand.pt
-        self.out_vars.loc[indices, "ISR_eta_CL" + out_label] = ISR_cand.eta
-        self.out_vars.loc[indices, "ISR_phi_CL" + out_label] = ISR_cand.phi
-        self.out_vars.loc[indices, "ISR_mass_CL" + out_label] = ISR_cand.mass
+        self.out_vars.fill("ISR_pt_CL" + out_label, ISR_cand.pt, indices)
+        self.out_vars.fill("ISR_eta_CL" + out_label, ISR_cand.eta, indices)
+        self.out_vars.fill("ISR_phi_CL" + out_label, ISR_cand.phi, indices)
+        self.out_vars.fill("ISR_mass_CL" + out_label, ISR_cand.mass, indices)
 
 
 def ISRRemovalMethod(self, indices, tracks, SUEP_cand, ISR_cand):
@@ -172,21 +172,23 @@ def ISRRemovalMethod(self, indices, tracks, SUEP_cand, ISR_cand):
         tracks = tracks[oneIRMtrackCut]
         indices = indices[oneIRMtrackCut]
 
-        self.out_vars.loc[indices, "SUEP_dphi_SUEP_ISR_IRM"] = ak.mean(
-            abs(SUEP_cand.deltaphi(ISR_cand_IRM)), axis=-1
+        self.out_vars.fill(
+            "SUEP_dphi_SUEP_ISR_IRM",
+            ak.mean(abs(SUEP_cand.deltaphi(ISR_cand_IRM)), axis=-1),
+            indices,
         )
 
         # SUEP jet variables
-        eigs = sphericity(SUEP_tracks_b, 1.0)  # Set r=1.0 for IRC safe
-        self.out_vars.loc[indices, "SUEP_nconst_IRM"] = ak.num(SUEP_tracks_b)
-        self.out_vars.loc[indices, "SUEP_pt_avg_b_IRM"] = ak.mean(
-            SUEP_tracks_b.pt, axis=-1
+        S1 = sphericity(SUEP_tracks_b, 1.0, only_S1=True)  # Set r=1.0 for IRC safe
+        self.out_vars.fill("SUEP_nconst_IRM", ak.num(SUEP_tracks_b), indices)
+        self.out_vars.fill(
+            "SUEP_pt_avg_b_IRM", ak.mean(SUEP_tracks_b.pt, axis=-1), indices
         )
-        self.out_vars.loc[indices, "SUEP_S1_IRM"] = 1.5 * (eigs[:, 1] + eigs[:, 0])
+        self.out_vars.fill("SUEP_S1_IRM", S1, indices)
 
         # unboost for these
         SUEP_tracks = SUEP_tracks_b.boost_p4(SUEP_cand)
-        self.out_vars.loc[indices, "SUEP_pt_avg_IRM"] = ak.mean(SUEP_tracks.pt, axis=-1)
+        self.out_vars.fill("SUEP_pt_avg_IRM", ak.mean(SUEP_tracks.pt, axis=-1), indices)
         deltaR = SUEP_tracks.deltaR(SUEP_cand)
         # self.out_vars.loc[indices, "SUEP_rho0_IRM"] = rho(0, SUEP_cand, SUEP_tracks, deltaR)
         # self.out_vars.loc[indices, "SUEP_rho1_IRM"] = rho(1, SUEP_cand, SUEP_tracks, deltaR)
@@ -201,10 +203,10 @@ def ISRRemovalMethod(self, indices, tracks, SUEP_cand, ISR_cand):
             },
             with_name="Momentum4D",
         )
-        self.out_vars.loc[indices, "SUEP_pt_IRM"] = SUEP.pt
-        self.out_vars.loc[indices, "SUEP_eta_IRM"] = SUEP.eta
-        self.out_vars.loc[indices, "SUEP_phi_IRM"] = SUEP.phi
-        self.out_vars.loc[indices, "SUEP_mass_IRM"] = SUEP.mass
+        self.out_vars.fill("SUEP_pt_IRM", SUEP.pt, indices)
+        self.out_vars.fill("SUEP_eta_IRM", SUEP.eta, indices)
+        self.out_vars.fill("SUEP_phi_IRM", SUEP.phi, indices)
+        self.out_vars.fill("SUEP_mass_IRM", SUEP.mass, indices)
 
 
 def ConeMethod(self, indices, tracks, SUEP_cand, ISR_cand, do_inverted=False):
@@ -259,24 +261,24 @@ def ConeMethod(self, indices, tracks, SUEP_cand, ISR_cand, do_inverted=False):
         SUEP_tracks_b = SUEP_tracks.boost_p4(boost_SUEP)
 
         # SUEP jet variables
-        eigs = sphericity(SUEP_tracks_b, 1.0)  # Set r=1.0 for IRC safe
-        self.out_vars.loc[indices, "SUEP_nconst_CO"] = ak.num(SUEP_tracks_b)
-        self.out_vars.loc[indices, "SUEP_pt_avg_b_CO"] = ak.mean(
-            SUEP_tracks_b.pt, axis=-1
+        S1 = sphericity(SUEP_tracks_b, 1.0, only_S1=True)  # Set r=1.0 for IRC safe
+        self.out_vars.fill("SUEP_nconst_CO", ak.num(SUEP_tracks_b), indices)
+        self.out_vars.fill(
+            "SUEP_pt_avg_b_CO", ak.mean(SUEP_tracks_b.pt, axis=-1), indices
         )
-        self.out_vars.loc[indices, "SUEP_S1_CO"] = 1.5 * (eigs[:, 1] + eigs[:, 0])
+        self.out_vars.fill("SUEP_S1_CO", S1, indices)
 
         # unboost for these
         SUEP_tracks = SUEP_tracks_b.boost_p4(SUEP_cand)
-        self.out_vars.loc[indices, "SUEP_pt_avg_CO"] = ak.mean(SUEP_tracks.pt, axis=-1)
+        self.out_vars.fill("SUEP_pt_avg_CO", ak.mean(SUEP_tracks.pt, axis=-1), indices)
         deltaR = SUEP_tracks.deltaR(SUEP_cand)
         # self.out_vars.loc[indices, "SUEP_rho0_CO"] = rho(0, SUEP_cand, SUEP_tracks, deltaR)
         # self.out_vars.loc[indices, "SUEP_rho1_CO"] = rho(1, SUEP_cand, SUEP_tracks, deltaR)
 
-        self.out_vars.loc[indices, "SUEP_pt_CO"] = SUEP_cand.pt
-        self.out_vars.loc[indices, "SUEP_eta_CO"] = SUEP_cand.eta
-        self.out_vars.loc[indices, "SUEP_phi_CO"] = SUEP_cand.phi
-        self.out_vars.loc[indices, "SUEP_mass_CO"] = SUEP_cand.mass
+        self.out_vars.fill("SUEP_pt_CO", SUEP_cand.pt, indices)
+        self.out_vars.fill("SUEP_eta_CO", SUEP_cand.eta, indices)
+        self.out_vars.fill("SUEP_phi_CO", SUEP_cand.phi, indices)
+        self.out_vars.fill("SUEP_mass_CO", SUEP_cand.mass, indices)
 
         # inverted selection
         if do_inverted:
@@ -318,108 +320,102 @@ def ConeMethod(self, indices, tracks, SUEP_cand, ISR_cand, do_inverted=False):
                 ISR_tracks_b = ISR_tracks.boost_p4(boost_ISR)
 
                 # ISR jet variables
-                eigs = sphericity(ISR_tracks_b, 1.0)  # Set r=1.0 for IRC safe
-                self.out_vars.loc[indices, "ISR_nconst_CO"] = ak.num(ISR_tracks_b)
-                self.out_vars.loc[indices, "ISR_pt_avg_b_CO"] = ak.mean(
-                    ISR_tracks_b.pt, axis=-1
+                S1 = sphericity(
+                    ISR_tracks_b, 1.0, only_S1=True
+                )  # Set r=1.0 for IRC safe
+                self.out_vars.fill("ISR_nconst_CO", ak.num(ISR_tracks_b), indices)
+                self.out_vars.fill(
+                    "ISR_pt_avg_b_CO", ak.mean(ISR_tracks_b.pt, axis=-1), indices
                 )
-                self.out_vars.loc[indices, "ISR_pt_mean_scaled_CO"] = ak.mean(
-                    ISR_tracks_b.pt, axis=-1
-                ) / ak.max(ISR_tracks_b.pt, axis=-1)
-                self.out_vars.loc[indices, "ISR_S1_CO"] = 1.5 * (
-                    eigs[:, 1] + eigs[:, 0]
+                self.out_vars.fill(
+                    "ISR_pt_mean_scaled_CO",
+                    ak.mean(ISR_tracks_b.pt, axis=-1)
+                    / ak.max(ISR_tracks_b.pt, axis=-1),
+                    indices,
                 )
+                self.out_vars.fill("ISR_S1_CO", S1, indices)
 
                 # unboost for these
                 ISR_tracks = ISR_tracks_b.boost_p4(ISR_cand)
-                self.out_vars.loc[indices, "ISR_pt_avg_CO"] = ak.mean(
-                    ISR_tracks.pt, axis=-1
+                self.out_vars.fill(
+                    "ISR_pt_avg_CO", ak.mean(ISR_tracks.pt, axis=-1), indices
                 )
                 deltaR = ISR_tracks.deltaR(ISR_cand)
-                self.out_vars.loc[indices, "ISR_rho0_CO"] = rho(
-                    0, ISR_cand, ISR_tracks, deltaR
+                self.out_vars.fill(
+                    "ISR_rho0_CO", rho(0, ISR_cand, ISR_tracks, deltaR), indices
                 )
-                self.out_vars.loc[indices, "ISR_rho1_CO"] = rho(
-                    1, ISR_cand, ISR_tracks, deltaR
+                self.out_vars.fill(
+                    "ISR_rho1_CO", rho(1, ISR_cand, ISR_tracks, deltaR), indices
                 )
 
-                self.out_vars.loc[indices, "ISR_pt_CO"] = ISR_cand.pt
-                self.out_vars.loc[indices, "ISR_eta_CO"] = ISR_cand.eta
-                self.out_vars.loc[indices, "ISR_phi_CO"] = ISR_cand.phi
-                self.out_vars.loc[indices, "ISR_mass_CO"] = ISR_cand.mass
-
-
-def sphericity(particles, r):
-    norm = ak.sum(particles.p**r, axis=1, keepdims=True)
-    s = np.array(
-        [
-            [
-                ak.sum(
-                    particles.px * particles.px * particles.p ** (r - 2.0),
-                    axis=1,
-                    keepdims=True,
-                )
-                / norm,
-                ak.sum(
-                    particles.px * particles.py * particles.p ** (r - 2.0),
-                    axis=1,
-                    keepdims=True,
-                )
-                / norm,
-                ak.sum(
-                    particles.px * particles.pz * particles.p ** (r - 2.0),
-                    axis=1,
-                    keepdims=True,
-                )
-                / norm,
-            ],
-            [
-                ak.sum(
-                    particles.py * particles.px * particles.p ** (r - 2.0),
-                    axis=1,
-                    keepdims=True,
-                )
-                / norm,
-                ak.sum(
-                    particles.py * particles.py * particles.p ** (r - 2.0),
-                    axis=1,
-                    keepdims=True,
-                )
-                / norm,
-                ak.sum(
-                    particles.py * particles.pz * particles.p ** (r - 2.0),
-                    axis=1,
-                    keepdims=True,
-                )
-                / norm,
-            ],
-            [
-                ak.sum(
-                    particles.pz * particles.px * particles.p ** (r - 2.0),
-                    axis=1,
-                    keepdims=True,
-                )
-                / norm,
-                ak.sum(
-                    particles.pz * particles.py * particles.p ** (r - 2.0),
-                    axis=1,
-                    keepdims=True,
-                )
-                / norm,
-                ak.sum(
-                    particles.pz * particles.pz * particles.p ** (r - 2.0),
-                    axis=1,
-                    keepdims=True,
-                )
-                / norm,
-            ],
-        ]
-    )
-    s = np.squeeze(np.moveaxis(s, 2, 0), axis=3)
-    evals = np.sort(np.linalg.eigvalsh(s))
+                self.out_vars.fill("ISR_pt_CO", ISR_cand.pt, indices)
+                self.out_vars.fill("ISR_eta_CO", ISR_cand.eta, indices)
+                self.out_vars.fill("ISR_phi_CO", ISR_cand.phi, indices)
+                self.out_vars.fill("ISR_mass_CO", ISR_cand.mass, indices)
+
+
+def sphericity(particles, r, only_S1=False):
+    """
+    Generalized sphericity tensor eigenvalues of each event (or jet).
+    The six unique tensor components are accumulated in a single pass over the
+    flattened tracks and diagonalized with a closed-form 3x3 symmetric solver.
+    Returns: numpy array of dimensions (events x 3), eigenvalues in ascending order,
+    or, if only_S1 is set, the numpy array of S1 = 1.5 * (lambda_1 + lambda_2).
+    """
+    counts = ak.to_numpy(ak.num(particles, axis=1))
+    event_idx = np.repeat(np.arange(len(counts)), counts)
+
+    px = ak.to_numpy(ak.flatten(particles.px, axis=None)).astype(np.float64)
+    py = ak.to_numpy(ak.flatten(particles.py, axis=None)).astype(np.float64)
+    pz = ak.to_numpy(ak.flatten(particles.pz, axis=None)).astype(np.float64)
+    p2 = px * px + py * py + pz * pz
+    w = p2 ** ((r - 2.0) / 2.0)
+
+    def _sum(values):
+        return np.bincount(event_idx, weights=values, minlength=len(counts))
+
+    norm = _sum(p2 * w)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s_xx = _sum(px * px * w) / norm
+        s_yy = _sum(py * py * w) / norm
+        s_zz = _sum(pz * pz * w) / norm
+        s_xy = _sum(px * py * w) / norm
+        s_xz = _sum(px * pz * w) / norm
+        s_yz = _sum(py * pz * w) / norm
+
+    evals = eigvalsh_sym3(s_xx, s_yy, s_zz, s_xy, s_xz, s_yz)
+    if only_S1:
+        return 1.5 * (evals[:, 1] + evals[:, 0])
     return evals
 
 
+def eigvalsh_sym3(a_xx, a_yy, a_zz, a_xy, a_xz, a_yz):
+    """
+    Closed-form (trigonometric) eigenvalues of a batch of symmetric 3x3 matrices,
+    given as arrays of their six unique components.
+    Returns: numpy array of dimensions (batch x 3), eigenvalues in ascending order.
+    """
+    off = a_xy**2 + a_xz**2 + a_yz**2
+    q = (a_xx + a_yy + a_zz) / 3.0
+    b_xx, b_yy, b_zz = a_xx - q, a_yy - q, a_zz - q
+    p = np.sqrt((b_xx**2 + b_yy**2 + b_zz**2 + 2.0 * off) / 6.0)
+
+    # half the determinant of (A - qI) / p
+    with np.errstate(divide="ignore", invalid="ignore"):
+        det = (
+            b_xx * (b_yy * b_zz - a_yz * a_yz)
+            - a_xy * (a_xy * b_zz - a_yz * a_xz)
+            + a_xz * (a_xy * a_yz - b_yy * a_xz)
+        )
+        half_det = np.where(p > 0, det / (2.0 * p**3), 0.0)
+    phi = np.arccos(np.clip(half_det, -1.0, 1.0)) / 3.0
+
+    e_max = q + 2.0 * p * np.cos(phi)
+    e_min = q + 2.0 * p * np.cos(phi + 2.0 * np.pi / 3.0)
+    e_mid = 3.0 * q - e_max - e_min
+    return np.sort(np.stack([e_min, e_mid, e_max], axis=1), axis=1)
+
+
 def rho(number, jet, tracks, deltaR, dr=0.05):
     r_start = number * dr
     r_end = (number + 1) * dr
@@ -428,21 +424,66 @@ def rho(number, jet, tracks, deltaR, dr=0.05):
     return rho_values
 
 
-def FastJetReclustering(tracks, r, minPt):
-
-    jetdef = fastjet.JetDefinition(fastjet.antikt_algorithm, r)
-    cluster = fastjet.ClusterSequence(tracks, jetdef)
-
-    # have to set min_pt = 0 and cut later to avoid some memory issues
-    # FIXME: should try to understand this failure
-    ak_inclusive_jets = cluster.inclusive_jets()
-    ak_inclusive_cluster = cluster.constituents()
+def FastJetReclustering(tracks, r, minPt, min_jets=1):
+    """
+    Anti-kt reclustering of the tracks with radius r.
+    Returns the jets with pT > minPt, dimensions (events x jets), and their
+    constituents, dimensions (events x jets x tracks).
+    An event whose scalar sum of the track pT is below min_jets * minPt cannot have
+    min_jets such jets, so it is not clustered and gets no jets: with min_jets=1
+    the output is the same as clustering all the events.
+    Only the constituents of the jets passing minPt are gathered, by their indices
+    in the tracks of the event, rather than from cluster.constituents().
+    """
+
+    counts = ak.to_numpy(ak.num(tracks, axis=1))
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    # the scalar pT sum is an upper bound of the total pT of the jets of the event,
+    # with a small margin for the rounding of the jet momenta
+    pt_sum = ak.to_numpy(ak.sum(tracks.pt, axis=1))
+    clustered = np.flatnonzero(pt_sum >= min_jets * minPt * (1 - 1e-6))
+
+    njets = np.zeros(len(counts), dtype=np.int64)
+    if len(clustered) == 0:
+        # no event to cluster, e.g. all of them below the pT sum
+        empty = np.zeros(0)
+        jets = ak.zip(
+            {"px": empty, "py": empty, "pz": empty, "E": empty}, with_name="Momentum4D"
+        )
+        constituents = ak.flatten(tracks)[:0]
+        nconstituents = np.zeros(0, dtype=np.int64)
+    else:
+        jetdef = fastjet.JetDefinition(fastjet.antikt_algorithm, r)
+        cluster = fastjet.ClusterSequence(tracks[clustered], jetdef)
+
+        # have to set min_pt = 0 and cut later to avoid some memory issues
+        # FIXME: should try to understand this failure
+        ak_jets = cluster.inclusive_jets()
+        constituent_index = cluster.constituent_index()
+
+        # apply minimum pT cut
+        minPtCut = ak_jets.pt > minPt
+        ak_jets = ak_jets[minPtCut]
+        constituent_index = constituent_index[minPtCut]
+
+        # index of the constituents in the flattened tracks of all the events
+        njets[clustered] = ak.to_numpy(ak.num(ak_jets, axis=1))
+        nconst = ak.num(constituent_index, axis=2)
+        event = np.repeat(clustered, ak.to_numpy(ak.sum(nconst, axis=1)))
+        track_index = offsets[event] + ak.to_numpy(
+            ak.flatten(constituent_index, axis=None)
+        )
 
-    # apply minimum pT cut
-    minPtCut = ak_inclusive_jets.pt > minPt
+        jets = ak.flatten(ak_jets)
+        constituents = ak.flatten(tracks)[track_index]
+        nconstituents = ak.to_numpy(ak.flatten(nconst))
 
-    ak_inclusive_jets = ak_inclusive_jets[minPtCut]
-    ak_inclusive_cluster = ak_inclusive_cluster[minPtCut]
+    # expand back to all the events, the events not clustered have no jets
+    ak_inclusive_jets = ak.unflatten(jets, njets)
+    ak_inclusive_cluster = ak.unflatten(
+        ak.unflatten(constituents, nconstituents), njets
+    )
 
     return ak_inclusive_jets, ak_inclusive_cluster
 
@@ -494,6 +535,21 @@ def getTopTwoJets(self, tracks, indices, ak_inclusive_jets, ak_inclusive_cluster
     )
 
 
+def getGenSUEP(events, pdgId=25):
+    """
+    Kinematics (mass, pt, eta, phi) of the last gen particle with |pdgId| == pdgId
+    in each event, i.e. the last SUEP mediator in the decay chain.
+    Returns a dict of numpy arrays, set to 0 for events without such a particle.
+    """
+    genParts = events.GenPart
+    genSUEP = genParts[abs(genParts.pdgId) == pdgId]
+    lastSUEP = ak.firsts(genSUEP[:, -1:])
+    return {
+        var: ak.to_numpy(ak.fill_none(lastSUEP[var], 0))
+        for var in ["mass", "pt", "eta", "phi"]
+    }
+
+
 def convert_coords(coords, tracks, nobj):
     allowed_coords = ["cyl", "cart", "p4"]
     if coords.lower() not in allowed_coords:
@@ -511,6 +567,29 @@ def convert_coords(coords, tracks, nobj):
     return new_tracks
 
 
+def convert_coords_flat(coords, tracks):
+    """
+    Same features as convert_coords, but for the flattened tracks of all the
+    events, dimensions (tracks x 4), without the zero-padding.
+    """
+    coords = coords.lower()
+    if coords == "p4":
+        features = [tracks.px, tracks.py, tracks.pz, tracks.mass]
+    elif coords == "cart":
+        features = [
+            tracks.pt * np.cos(tracks.phi),
+            tracks.pt * np.sin(tracks.phi),
+            tracks.pt * np.sinh(tracks.eta),
+            tracks.mass,
+        ]
+    elif coords == "cyl":
+        features = [tracks.pt, tracks.eta, tracks.phi, tracks.mass]
+    else:
+        raise Exception(coords + " is not supported in convert_coords_flat.")
+
+    return np.stack([ak.to_numpy(ak.flatten(f)) for f in features], axis=-1)
+
+
 def convert_p4(tracks, nobj=10):
     """store objects in zero-padded numpy arrays"""
 
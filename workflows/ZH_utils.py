@@ -1,9 +1,11 @@
 import awkward as ak
 
 
-def selectByLeptons(self, events, extraColls=[], lepveto=False):
-    ###lepton selection criteria--4momenta collection for plotting
-
+def getLeptons(events):
+    """
+    Muons and electrons of the events as Momentum4D collections, built once and
+    shared by the lepton selections.
+    """
     muons = ak.zip(
         {
             "pt": events.Muon.pt,
@@ -26,6 +28,14 @@ def selectByLeptons(self, events, extraColls=[], lepveto=False):
         with_name="Momentum4D",
     )
 
+    return electrons, muons
+
+
+def selectLeptons(events, electrons, muons):
+    """
+    Selected electrons and muons, from the collections of getLeptons.
+    """
+
     ###  Some very simple selections on ID ###
     ###  Muons: loose ID + dxy dz cuts mimicking the medium prompt ID https://twiki.cern.ch/twiki/bin/viewauth/CMS/SWGuideMuonIdRun2
     ###  Electrons: loose ID + dxy dz cuts for promptness https://twiki.cern.ch/twiki/bin/view/CMS/EgammaCutBasedIdentification
@@ -52,6 +62,30 @@ def selectByLeptons(self, events, extraColls=[], lepveto=False):
     selMuons = muons[cutMuons]
     selElectrons = electrons[cutElectrons]
 
+    return selElectrons, selMuons
+
+
+def leptonVeto(selElectrons, selMuons):
+    """
+    Events with any selected lepton with pT >= 25, vetoed in the HT analyses.
+    """
+    cutAnyElecs = (ak.num(selElectrons, axis=1) > 0) & (
+        ak.max(selElectrons.pt, axis=1, mask_identity=False) >= 25
+    )
+
+    cutAnyMuons = (ak.num(selMuons, axis=1) > 0) & (
+        ak.max(selMuons.pt, axis=1, mask_identity=False) >= 25
+    )
+
+    return cutAnyElecs | cutAnyMuons
+
+
+def selectByLeptons(self, events, extraColls=[], lepveto=False):
+    ###lepton selection criteria--4momenta collection for plotting
+
+    electrons, muons = getLeptons(events)
+    selElectrons, selMuons = selectLeptons(events, electrons, muons)
+
     ### Now global cuts to select events. Notice this means exactly two leptons with pT >= 10, and the leading one pT >= 25
 
     # cutHasTwoMuons imposes three conditions:
@@ -80,15 +114,7 @@ def selectByLeptons(self, events, extraColls=[], lepveto=False):
         if lepveto:  # lepton veto used in the HT analyses for orthoganality
 
             # Cut out events with any lepton to also be orthogonal to possible WH analysis
-            cutAnyElecs = (ak.num(selElectrons, axis=1) > 0) & (
-                ak.max(selElectrons.pt, axis=1, mask_identity=False) >= 25
-            )
-
-            cutAnyMuons = (ak.num(selMuons, axis=1) > 0) & (
-                ak.max(selMuons.pt, axis=1, mask_identity=False) >= 25
-            )
-
-            cutAnyLeps = cutAnyElecs | cutAnyMuons
+            cutAnyLeps = leptonVeto(selElectrons, selMuons)
             events = events[~cutAnyLeps]
             selElectrons = selElectrons[~cutAnyLeps]
             selMuons = selMuons[~cutAnyLeps]
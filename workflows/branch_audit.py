@@ -0,0 +1,100 @@
+"""
+branch_audit.py
+Audit of the branches that a processor reads from the NanoAOD files, and a
+"preload" mode that reads exactly those branches of each chunk at once.
+
+A Runner with savemetrics=True records the branches that NanoEvents lazily
+materialized and the bytes requested from the files; write_report saves them
+as a json report. read_branches reads the branch list back from the report, and
+preload_events then fetches all of them for a chunk in one bulk uproot read
+(a single vector read over xrootd), rather than one read per branch.
+"""
+import json
+import warnings
+
+import uproot
+from coffea.nanoevents import NanoAODSchema, NanoEventsFactory
+from coffea.nanoevents.mapping.preloaded import SimplePreloadedColumnSource
+
+
+def write_report(metrics, path, fileset=None):
+    """
+    Writes the branches read and bytes read, from the metrics of a Runner with
+    savemetrics=True, to the json file path. Returns the report.
+    """
+    branches = sorted(set(metrics.get("columns", [])))
+    chunks = metrics.get("chunks", 0)
+    entries = metrics.get("entries", 0)
+    bytesread = metrics.get("bytesread", 0)
+    report = {
+        "fileset": fileset,
+        "chunks": chunks,
+        "entries": entries,
+        "bytesread": bytesread,
+        "bytes_per_chunk": bytesread / chunks if chunks else 0,
+        "bytes_per_event": bytesread / entries if entries else 0,
+        "processtime": metrics.get("processtime", 0),
+        "nbranches": len(branches),
+        "branches": branches,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def read_branches(path):
+    """Branches of a report from write_report."""
+    with open(path) as f:
+        return json.load(f)["branches"]
+
+
+class ChunkColumn:
+    """
+    Branch read for the entries [offset, offset + len(array)) of a tree, sliced
+    with the entry numbers of the whole tree, as NanoEvents expects.
+    """
+
+    def __init__(self, array, offset):
+        self.array = array
+        self.offset = offset
+
+    @property
+    def layout(self):
+        return self.array.layout
+
+    def __getitem__(self, entries):
+        return self.array[entries.start - self.offset : entries.stop - self.offset]
+
+
+def preload_events(events, branches, schemaclass=NanoAODSchema):
+    """
+    Reads the branches for the chunk of events in one bulk read, and returns the
+    events of the chunk built from them, with the same metadata and partition key.
+    Branches that are not in the file are skipped. Accessing any other branch
+    raises an error, so the report should come from the same kind of sample.
+    """
+    metadata = dict(events.metadata)
+    start, stop = metadata["entrystart"], metadata["entrystop"]
+
+    with uproot.open(metadata["filename"]) as f:
+        tree = f[metadata["treename"]]
+        branches = [b for b in branches if b in tree]
+        arrays = tree.arrays(branches, entry_start=start, entry_stop=stop, how=dict)
+        source = SimplePreloadedColumnSource(
+            {name: ChunkColumn(array, start) for name, array in arrays.items()},
+            uuid=str(tree.file.uuid),
+            num_rows=stop,
+            object_path=tree.object_path,
+        )
+
+    with warnings.catch_warnings():
+        # cross-references to collections that the analysis does not read
+        warnings.filterwarnings("ignore", message="Missing cross-reference")
+        factory = NanoEventsFactory.from_preloaded(
+            source,
+            entry_start=start,
+            entry_stop=stop,
+            schemaclass=schemaclass,
+            metadata=metadata,
+        )
+    return factory.events()
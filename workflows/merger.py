@@ -7,6 +7,7 @@
 # N.B.: Only merging df named 'vars' in the HDF5 object
 
 import glob
+import json
 import os
 import sys
 
@@ -14,6 +15,8 @@ import h5py
 import numpy as np
 import pandas as pd
 
+from workflows.pandas_utils import write_parquet
+
 
 def h5load(ifile, label):
     try:
@@ -31,16 +34,99 @@ def h5load(ifile, label):
         return 0, 0
 
 
-def merge(options, pattern="condor_*.hdf5", outFile="out.hdf5"):
+def merge(options, pattern="condor_*.hdf5", outFile="out.hdf5", bounded_memory=False):
     files = glob.glob(pattern)
     if len(files) == 0:
         print("No .hdf5 files found")
         sys.exit()
 
-    df_tot = None
-    metadata_tot = None
-    for ifile, file in enumerate(files):
+    if bounded_memory:
+        merge_bounded(options, files, outFile)
+    else:
+        df_tot = None
+        metadata_tot = None
+        dfs = []
+        for ifile, file in enumerate(files):
+
+            df, metadata = h5load(file, "vars")
+
+            ### Error out here
+            if type(df) == int:
+                print("Something screwed up.")
+                sys.exit()
+
+            ### MERGE METADATA
+            metadata_tot = merge_metadata(options, metadata_tot, metadata)
+
+            # no need to add empty ones
+            if "empty" in list(df.keys()):
+                continue
+
+            dfs.append(df)
+
+        ### MERGE DF, all at once: concatenating in the loop is quadratic
+        if len(dfs) > 0:
+            df_tot = pd.concat(dfs)
+
+        # SAVE OUTPUTS
+        if df_tot is None:
+            print("No events in df_tot.")
+            df_tot = pd.DataFrame(["empty"], columns=["empty"])
+        store = pd.HDFStore(outFile)
+        store.put("vars", df_tot)
+        store.get_storer("vars").attrs.metadata = metadata_tot
+        store.close()
+
+    # clean up the chunk files that we have already merged together
+    for file in files:
+        os.remove(file)
+    return
 
+
+def merge_metadata(options, metadata_tot, metadata):
+    if metadata_tot is None:
+        return metadata
+    if options.isMC:
+        metadata_tot["gensumweight"] += metadata["gensumweight"]
+    return metadata_tot
+
+
+def union_dtypes(schemas):
+    """
+    Union of the columns of the chunks (list of column -> dtype dicts), with a
+    dtype that can hold all of them. Columns missing from some of the chunks
+    are filled with NaN, so they must be floats.
+    """
+    dtypes = {}
+    nfiles = {}
+    for schema in schemas:
+        for column, dtype in schema.items():
+            dtype = np.dtype(dtype)
+            dtypes[column] = (
+                np.result_type(dtypes[column], dtype) if column in dtypes else dtype
+            )
+            nfiles[column] = nfiles.get(column, 0) + 1
+
+    for column, dtype in dtypes.items():
+        if nfiles[column] < len(schemas) and dtype.kind in "biu":
+            dtypes[column] = np.result_type(dtype, np.float32)
+
+    return dtypes
+
+
+def merge_bounded(options, files, outFile):
+    """
+    Merge holding a single chunk in memory at a time: each chunk's vars table is
+    appended to an on-disk table (HDFStore format="table").
+    The chunks can have different columns (e.g. those with no events passing the
+    selections), so a first pass collects the union of the columns and their
+    dtypes, and each chunk is conformed to it before being appended.
+    """
+
+    # first pass: schema and metadata
+    metadata_tot = None
+    schemas = []
+    for file in files:
         df, metadata = h5load(file, "vars")
 
         ### Error out here
@@ -49,33 +135,109 @@ def merge(options, pattern="condor_*.hdf5", outFile="out.hdf5"):
             sys.exit()
 
         ### MERGE METADATA
-        if metadata_tot is None:
-            metadata_tot = metadata
-        elif options.isMC:
-            metadata_tot["gensumweight"] += metadata["gensumweight"]
+        metadata_tot = merge_metadata(options, metadata_tot, metadata)
 
         # no need to add empty ones
         if "empty" in list(df.keys()):
             continue
 
-        ### MERGE DF
-        if df_tot is None:
-            df_tot = df
-        else:
-            df_tot = pd.concat((df_tot, df))
+        schemas.append(df.dtypes.to_dict())
+        del df
+
+    dtypes = union_dtypes(schemas)
+
+    # second pass: append the chunks to the output table
+    store = pd.HDFStore(outFile, mode="w")
+    for file in files:
+        df, _ = h5load(file, "vars")
+        if "empty" in list(df.keys()):
+            continue
+        df = df.reindex(columns=list(dtypes.keys())).astype(dtypes)
+        store.append("vars", df, format="table", index=False)
+        del df
 
     # SAVE OUTPUTS
-    if df_tot is None:
+    if "vars" not in store:
         print("No events in df_tot.")
-        df_tot = pd.DataFrame(["empty"], columns=["empty"])
-    store = pd.HDFStore(outFile)
-    store.put("vars", df_tot)
+        store.put("vars", pd.DataFrame(["empty"], columns=["empty"]))
     store.get_storer("vars").attrs.metadata = metadata_tot
     store.close()
 
+
+def parquet_load(ifile):
+    import pyarrow.parquet as pq
+
+    try:
+        table = pq.read_table(ifile)
+        metadata = json.loads(table.schema.metadata[b"metadata"])
+        return table, metadata
+    except Exception:
+        print("Some error occurred", ifile)
+        return 0, 0
+
+
+def merge_parquet(options, pattern="condor_*.parquet", outFile="out.parquet"):
+    """
+    Merge the Parquet chunks, one row group per chunk, streaming them to the
+    output file so that a single chunk is held in memory at a time.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    files = glob.glob(pattern)
+    if len(files) == 0:
+        print("No .parquet files found")
+        sys.exit()
+
+    # first pass, on the footers only: schema and metadata
+    metadata_tot = None
+    schemas = []
+    for file in files:
+        try:
+            schema = pq.read_schema(file)
+            metadata = json.loads(schema.metadata[b"metadata"])
+        except Exception:
+            ### Error out here
+            print("Something screwed up.", file)
+            sys.exit()
+
+        ### MERGE METADATA
+        metadata_tot = merge_metadata(options, metadata_tot, metadata)
+
+        # no need to add empty ones
+        if "empty" in schema.names:
+            continue
+        schemas.append({field.name: field.type.to_pandas_dtype() for field in schema})
+
+    dtypes = union_dtypes(schemas)
+
+    # SAVE OUTPUTS
+    if len(dtypes) == 0:
+        print("No events in df_tot.")
+        write_parquet(pd.DataFrame(["empty"], columns=["empty"]), outFile, metadata_tot)
+    else:
+        schema = pa.Schema.from_pandas(
+            pd.DataFrame({c: pd.Series(dtype=t) for c, t in dtypes.items()}),
+            preserve_index=False,
+        )
+        schema = schema.with_metadata(
+            {b"metadata": json.dumps(metadata_tot, default=float).encode()}
+        )
+        with pq.ParquetWriter(outFile, schema, compression="zstd") as writer:
+            for file in files:
+                table, _ = parquet_load(file)
+                if "empty" in table.column_names:
+                    continue
+                df = table.to_pandas().reindex(columns=list(dtypes.keys()))
+                df = df.astype(dtypes)
+                writer.write_table(
+                    pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+                )
+                del table, df
+
     # clean up the chunk files that we have already merged together
     for file in files:
-        os.system("rm " + str(file))
+        os.remove(file)
     return
 
 
@@ -89,7 +251,6 @@ def merge_ML(options):
         sys.exit()
 
     output = {}
-    firstFile = True
     for ifile, file in enumerate(files):
         f = h5py.File(file, "r")
 
@@ -102,14 +263,13 @@ def merge_ML(options):
             data = f[key]
             data = data[:]
 
-            if firstFile:
-                output[key] = data
-            else:
-                output[key] = np.vstack((output[key], data))
+            output.setdefault(key, []).append(data)
 
-        firstFile = False
         f.close()
 
+    # stack all at once: stacking in the loop is quadratic
+    output = {key: np.vstack(items) for key, items in output.items()}
+
     # save to file
     outFile = "out.hdf5"
     with h5py.File(outFile, "w") as outFile:
@@ -118,6 +278,6 @@ def merge_ML(options):
 
     # clean up the chunk files that we have already merged together
     for file in files:
-        os.system("rm " + str(file))
+        os.remove(file)
 
     return
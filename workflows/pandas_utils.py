@@ -1,12 +1,89 @@
+import json
 import os
 import pathlib
 import shutil
 from typing import List, Optional
 
 import awkward as ak
+import numpy as np
 import pandas as pd
 
 
+class OutputBuilder:
+    """
+    Columnar builder for the per-event outputs of a chunk.
+    Columns are kept as typed numpy arrays (floats as float32, integers as int32),
+    either set whole, builder[column] = values, or scattered to a subset of the
+    events, builder.fill(column, values, indices). The DataFrame is only built
+    once, by to_dataframe(), at the end of the chunk.
+    """
+
+    def __init__(self, nevents=None):
+        self.reset(nevents)
+
+    def reset(self, nevents=None):
+        self.nevents = nevents
+        self.columns = {}
+
+    def allocate(self, nevents):
+        """Fix the number of events of the chunk, if not already known."""
+        if self.nevents is None:
+            self.nevents = nevents
+        elif self.nevents != nevents:
+            raise ValueError(
+                f"OutputBuilder has {self.nevents} events, cannot allocate {nevents}."
+            )
+
+    @staticmethod
+    def _to_numpy(values):
+        if isinstance(values, ak.Array):
+            values = ak.to_numpy(values)
+        elif isinstance(values, pd.Series):
+            values = values.to_numpy()
+        if isinstance(values, np.ma.MaskedArray):
+            values = values.astype(np.float64).filled(np.nan)
+        return np.asarray(values)
+
+    @staticmethod
+    def _compact_dtype(dtype):
+        if dtype.kind == "f":
+            return np.float32
+        if dtype.kind == "i":
+            return np.int32
+        return dtype
+
+    def __len__(self):
+        return 0 if self.nevents is None else self.nevents
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def __setitem__(self, column, values):
+        values = self._to_numpy(values)
+        dtype = self._compact_dtype(values.dtype)
+        if values.ndim == 0:
+            self.allocate(0 if self.nevents is None else self.nevents)
+            self.columns[column] = np.full(self.nevents, values, dtype=dtype)
+        else:
+            self.allocate(len(values))
+            self.columns[column] = values.astype(dtype, copy=False)
+
+    def fill(self, column, values, indices):
+        """
+        Scatter values to the events at indices. Columns are created as float32
+        filled with NaN, so the events that are not filled stay NaN.
+        """
+        if column not in self.columns:
+            self.columns[column] = np.full(self.nevents, np.nan, dtype=np.float32)
+        self.columns[column][indices] = self._to_numpy(values)
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.columns, index=np.arange(len(self)))
+
+
 def ak_to_pandas(self, jet_collection: ak.Array) -> pd.DataFrame:
     out_df = pd.DataFrame()
     for field in ak.fields(jet_collection):
@@ -28,6 +105,19 @@ def h5store(
     store.get_storer(gname).attrs.metadata = kwargs
 
 
+def get_metadata(self):
+    if self.isMC:
+        metadata = dict(
+            gensumweight=self.gensumweight,
+            era=self.era,
+            mc=self.isMC,
+            sample=self.sample,
+        )
+    else:
+        metadata = dict(era=self.era, mc=self.isMC, sample=self.sample)
+    return metadata
+
+
 def save_dfs(self, dfs, df_names, fname):
     # fname = "out.hdf5"
     subdirs = []
@@ -35,17 +125,7 @@ def save_dfs(self, dfs, df_names, fname):
     if self.output_location is not None:
         # pandas to hdf5
         for out, gname in zip(dfs, df_names):
-            if self.isMC:
-                metadata = dict(
-                    gensumweight=self.gensumweight,
-                    era=self.era,
-                    mc=self.isMC,
-                    sample=self.sample,
-                )
-                # metadata.update({gensumweight:self.gensumweight})
-            else:
-                metadata = dict(era=self.era, mc=self.isMC, sample=self.sample)
-
+            metadata = get_metadata(self)
             store_fin = h5store(self, store, out, fname, gname, **metadata)
 
         store.close()
@@ -55,6 +135,34 @@ def save_dfs(self, dfs, df_names, fname):
         store.close()
 
 
+def write_parquet(df, fname, metadata, compression="zstd"):
+    """
+    Write df as a Parquet file, with the metadata (gensumweight, era, ...) stored
+    as json in the file footer, under the key "metadata".
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata(
+        {
+            **(table.schema.metadata or {}),
+            b"metadata": json.dumps(metadata, default=float).encode(),
+        }
+    )
+    pq.write_table(table, fname, compression=compression)
+
+
+def save_parquet(self, df, fname):
+    # fname = "out.parquet"
+    subdirs = []
+    if self.output_location is not None:
+        write_parquet(df, fname, get_metadata(self))
+        dump_table(self, fname, self.output_location, subdirs)
+    else:
+        print("self.output_location is None")
+
+
 def dump_table(
     self, fname: str, location: str, subdirs: Optional[List[str]] = None
 ) -> None:
@@ -0,0 +1,105 @@
+"""
+stage_profiler.py
+Opt-in profiling of the stages of a processor: wall time, CPU time, growth of
+the peak RSS and number of events of each stage, kept in coffea accumulators so
+that they merge across chunks and workers.
+"""
+import contextlib
+import resource
+import time
+
+from coffea import processor
+
+
+class max_accumulator(processor.defaultdict_accumulator):
+    """A defaultdict_accumulator keeping the maximum of each key, not the sum."""
+
+    def identity(self):
+        return max_accumulator(self.default_factory)
+
+    def add(self, other):
+        for key, value in other.items():
+            self[key] = max(self[key], value)
+
+
+def profile_accumulator():
+    return processor.dict_accumulator(
+        {
+            "calls": processor.defaultdict_accumulator(int),
+            "events": processor.defaultdict_accumulator(int),
+            "wall": processor.defaultdict_accumulator(float),
+            "cpu": processor.defaultdict_accumulator(float),
+            "rss": max_accumulator(float),
+        }
+    )
+
+
+class StageProfiler:
+    """
+    Records the stages of a chunk, used as
+        with profiler.stage("name", nevents):
+            ...
+    When disabled, stage() returns a shared nullcontext and records nothing.
+    rss is the growth of the peak resident memory of the process (ru_maxrss, in
+    MB) during the stage, i.e. how much the stage raised the memory high-water mark.
+    """
+
+    _disabled = contextlib.nullcontext()
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.accumulator = profile_accumulator() if enabled else None
+
+    def stage(self, name, nevents=0):
+        if not self.enabled:
+            return self._disabled
+        return self._stage(name, nevents)
+
+    @contextlib.contextmanager
+    def _stage(self, name, nevents):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.accumulator["calls"][name] += 1
+            self.accumulator["events"][name] += nevents
+            self.accumulator["wall"][name] += time.perf_counter() - wall
+            self.accumulator["cpu"][name] += time.process_time() - cpu
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+            self.accumulator["rss"][name] = max(
+                self.accumulator["rss"][name], rss / 1024
+            )
+
+
+def summary(profile):
+    """
+    Table of the profile accumulator, one line per stage, slowest first.
+    N.B.: stages can be nested, the time of the inner ones is included in the outer.
+    """
+    stages = sorted(profile["wall"], key=lambda s: profile["wall"][s], reverse=True)
+    lines = [
+        "{:<24} {:>7} {:>10} {:>10} {:>10} {:>12} {:>10}".format(
+            "stage",
+            "calls",
+            "events",
+            "wall [s]",
+            "cpu [s]",
+            "ms / event",
+            "rss [MB]",
+        )
+    ]
+    for s in stages:
+        events = profile["events"][s]
+        lines.append(
+            "{:<24} {:>7} {:>10} {:>10.2f} {:>10.2f} {:>12.3f} {:>10.1f}".format(
+                s,
+                profile["calls"][s],
+                events,
+                profile["wall"][s],
+                profile["cpu"][s],
+                1000 * profile["wall"][s] / events if events else 0,
+                profile["rss"][s],
+            )
+        )
+    return "\n".join(lines)